@@ -0,0 +1,158 @@
+import contextlib
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+from .statement import STMT
+
+# Quoted strings, some of them are the names of data files
+QUOTED_RE = re.compile(r"(['\"])(.+?)\1")
+
+# plot and splot statements, not replot
+PLOT_ONLY_RE = re.compile(r"^\s*(?:plot|plo|pl|p|splot|splo|spl|sp)\b")
+
+# An assignment, e.g. "a=1" or "f(x)=x" but not "a==1"
+ASSIGNMENT_RE = re.compile(r"(?<![=!<>])=(?!=)")
+
+
+class RenderCache:
+    """
+    Images of cells, stored on disk
+
+    Each entry is a directory that holds the images of a cell, in
+    the order in which they were made. The entries are named by a
+    key of what made the images. When the cache is larger than
+    max_size, the entries that were used least recently are
+    removed.
+
+    Parameters
+    ----------
+    path : str | Path
+        Directory of the cache
+    max_size : int
+        Maximum size in bytes of the images in the cache
+    """
+
+    def __init__(self, path: "str | Path", max_size: int):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> list[Path] | None:
+        """
+        Return the images of an entry, or None if there is none
+        """
+        entry = self.path / key
+        try:
+            images = sorted(entry.iterdir())
+        except FileNotFoundError:
+            return None
+
+        # Mark it as used
+        os.utime(entry)
+        return images
+
+    def new_entry(self) -> Path:
+        """
+        Create a directory in which to put the images of an entry
+        """
+        return Path(tempfile.mkdtemp(prefix=".new-", dir=self.path))
+
+    def add(self, key: str, entry: Path):
+        """
+        Add an entry made with new_entry to the cache
+        """
+        try:
+            entry.rename(self.path / key)
+        except OSError:
+            # Added by someone else
+            self.discard(entry)
+        self.evict()
+
+    def discard(self, entry: Path):
+        """
+        Delete an entry made with new_entry
+        """
+        shutil.rmtree(entry, ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries to fit in max_size
+        """
+        entries = []
+        total = 0
+        for entry in self.path.iterdir():
+            if entry.name.startswith("."):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+                total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def is_plot_only(code: str) -> bool:
+    """
+    Return True if a cell plots and does nothing else
+
+    Running such a cell has no effect on the gnuplot session other
+    than the images, so the images can be cached. Every statement,
+    including those after ';' and in loops, must be a plot or splot
+    statement without assignments. Replot is left out, what it draws
+    is not in the cell.
+    """
+    stmts = _statements(code)
+    return bool(stmts) and all(
+        PLOT_ONLY_RE.match(stmt) and not ASSIGNMENT_RE.search(stmt)
+        for stmt in stmts
+    )
+
+
+def cell_key(code: str, *context: str, cwd: Path) -> str:
+    """
+    Return the cache key of a cell
+
+    Parameters
+    ----------
+    code : str
+        Code of the cell
+    context : str
+        Everything else that the images depend on, e.g. the
+        terminal and the state of the session.
+    cwd : Path
+        Working directory of gnuplot, the directory of relative
+        data file names.
+    """
+    h = hashlib.sha256()
+    for part in (code, *context, str(cwd)):
+        h.update(part.encode())
+        h.update(b"\0")
+
+    # Data files are identified by their name, size and time of
+    # modification
+    for stmt in _statements(code):
+        for _, name in QUOTED_RE.findall(stmt):
+            with contextlib.suppress(OSError):
+                st = (cwd / name).stat()
+                h.update(f"{name}:{st.st_size}:{st.st_mtime_ns}\0".encode())
+
+    return h.hexdigest()
+
+
+def _statements(code: str) -> list[STMT]:
+    """
+    Return the simple statements of a cell, without comments
+    """
+    return [
+        stmt
+        for line in code.splitlines()
+        for stmt in STMT(line).substatements()
+    ]
@@ -0,0 +1,81 @@
+"""
+Inline images that gnuplot writes to named pipes
+
+gnuplot writes each image to one of two FIFOs, taking turns, and
+closes the output after the image. The end of an image is the end
+of the data in its FIFO. Taking turns keeps the images apart:
+gnuplot cannot open a FIFO for the next image before the reader
+has finished the previous image and opened the other FIFO, and by
+the time gnuplot comes back to the first FIFO the reader has closed
+it.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import itertools
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class ImageCapture:
+    """
+    Read the images that gnuplot writes to a pair of FIFOs
+
+    The images are read in a background thread as gnuplot writes
+    them, so gnuplot does not wait on a reader.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the FIFOs, they are created if they do not
+        exist.
+    """
+
+    def __init__(self, path: Path):
+        # Template of the names of the FIFOs, for the image counter.
+        # The counter has to be even for the first image.
+        self.template = str(path / "gnuplot-capture-%d")
+        self.fifos = [Path(self.template % i) for i in range(2)]
+        for fifo in self.fifos:
+            if not fifo.exists():
+                os.mkfifo(fifo)
+
+        # The images in the order in which they were written
+        self.images: list[bytes] = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for i in itertools.count():
+            data = self.fifos[i % 2].read_bytes()
+            if self._closed and not data:
+                return
+            self.images.append(data)
+
+    def close(self, timeout: float = 5):
+        """
+        Stop reading once gnuplot has closed its last output
+
+        The reader waits for gnuplot to open the FIFO of the next
+        image. Opening it and closing it without writing sets the
+        reader free.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time (seconds) to wait for the reader. If
+            gnuplot still has a FIFO open, the reader is left
+            behind and the images it has not read are lost.
+        """
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        while self._thread.is_alive() and time.monotonic() < deadline:
+            for fifo in self.fifos:
+                # Fails if there is no reader on the FIFO
+                with contextlib.suppress(OSError):
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            self._thread.join(0.01)
@@ -0,0 +1,291 @@
+"""
+Binary copies of the text data files that are plotted
+
+gnuplot parses a text data file each time it is plotted. A copy of
+the file as a matrix of doubles, in gnuplot's binary format, is
+read without any parsing.
+"""
+
+import hashlib
+import os
+import re
+import sys
+import tempfile
+from array import array
+from collections.abc import Callable
+from pathlib import Path
+
+from .replwrap import START_DATABLOCK_RE
+
+# Statements that read data files
+DATA_CMD_RE = re.compile(
+    r"^(?P<cmd>\s*(?:plot|plo|pl|p|splot|splo|spl|sp|stats|stat)\b\s*)"
+)
+
+# A data file that is a plain file, not inline data ('-'), a
+# special file ('+' and '++') or a command ('< cmd')
+FILENAME_RE = re.compile(
+    r"""^(?P<quote>['"])(?P<name>[^'"<+-][^'"]*)(?P=quote)"""
+)
+
+# A quoted file name, '' is the previous file of the statement
+QUOTED_NAME_RE = re.compile(r"""^(?P<quote>['"])(?P<name>[^'"]*)(?P=quote)""")
+
+# A datablock, e.g. $data
+DATABLOCK_NAME_RE = re.compile(r"^\$\w+")
+
+# Modifiers that the binary copy does not support, or that need the
+# layout (blank lines) or the text of the file. Quotes in a using
+# specification are column names or string functions.
+UNSUPPORTED_RE = re.compile(
+    r"\b(?:binary|matrix|nonuniform|index|ind|every|skip|"
+    r"strcol|stringcolumn|\w*tic(?:label)?s?|key|columnhead(?:er)?)\b"
+    r"|\b(?:using|usin|usi|us|u)\s+\S*['\"]"
+)
+
+# Without a using specification, gnuplot reads text and binary
+# files differently
+USING_RE = re.compile(r"\b(?:using|usin|usi|us|u)\s")
+
+BINARY_FORMAT = "%float64"
+
+# Number of values converted before they are written to the copy
+CHUNK_SIZE = 1 << 16
+
+
+class BinaryDataCache:
+    """
+    Binary copies of text data files
+
+    The copies are made the first time a file is plotted and are
+    named by a key of the path, size and modification time of the
+    file. Files that cannot be copied, e.g. because they have text
+    columns or blank lines, are marked so that they are not read
+    again.
+
+    Parameters
+    ----------
+    path : str | Path
+        Directory of the copies
+    """
+
+    def __init__(self, path: "str | Path"):
+        # gnuplot may have a different working directory
+        self.path = Path(path).absolute()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def rewrite(
+        self, code: str, cwd: Callable[[], Path | None] = lambda: None
+    ) -> str:
+        """
+        Make the statements of a cell read the binary copies
+
+        Only the data files of plot, splot and stats statements
+        that have a using specification and that do not need the
+        text of the file are replaced.
+
+        Parameters
+        ----------
+        code : str
+            Code of the cell
+        cwd : callable
+            Returns the working directory of gnuplot, which relative
+            file names are relative to. It is called when the first
+            relative name is found. If it returns None, the relative
+            names are left as they are.
+        """
+        lines = []
+        end_string = ""
+        for line in code.splitlines():
+            if end_string:
+                if line == end_string:
+                    end_string = ""
+            elif m := START_DATABLOCK_RE.match(line):
+                end_string = m.group("end")
+            elif m := DATA_CMD_RE.match(line):
+                elements = name_previous_files(split_elements(line[m.end() :]))
+                line = m.group("cmd") + ",".join(
+                    self._rewrite_element(e, cwd) for e in elements
+                )
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _rewrite_element(
+        self, element: str, cwd: Callable[[], Path | None]
+    ) -> str:
+        """
+        Replace the data file of a plot element with its copy
+        """
+        if not (parts := split_ranges(element)):
+            return element
+
+        prefix, stripped = parts
+        m = FILENAME_RE.match(stripped)
+        if not m:
+            return element
+
+        modifiers = stripped[m.end() :]
+        if not USING_RE.search(modifiers) or UNSUPPORTED_RE.search(modifiers):
+            return element
+
+        filename = Path(m.group("name"))
+        if not filename.is_absolute():
+            if (directory := cwd()) is None:
+                return element
+            filename = directory / filename
+
+        spec = self.get(filename)
+        if spec is None:
+            return element
+        return f"{prefix}{spec}{modifiers}"
+
+    def get(self, filename: Path) -> str | None:
+        """
+        Return the binary data specification of a copy of a file
+
+        The copy is made if there is none. Returns None if the file
+        does not exist or cannot be copied.
+        """
+        try:
+            st = filename.stat()
+        except OSError:
+            return None
+
+        key = hashlib.sha256(
+            f"{filename.resolve()}:{st.st_size}:{st.st_mtime_ns}".encode()
+        ).hexdigest()
+        copy = next(self.path.glob(f"{key}.*"), None)
+        if copy is None:
+            copy = self._convert(filename, key)
+
+        if copy.suffix != ".bin":
+            return None
+
+        ncols = int(copy.name.split(".")[1])
+        nrows = copy.stat().st_size // (8 * ncols)
+        return (
+            f"'{copy}' binary record={nrows} "
+            f"format='{BINARY_FORMAT * ncols}' endian={sys.byteorder}"
+        )
+
+    def _convert(self, filename: Path, key: str) -> Path:
+        """
+        Make a binary copy of a text data file
+
+        Returns the path to the copy, "<key>.<ncols>.bin", or to a
+        "<key>.none" marker if the file cannot be copied.
+
+        The file is read a line at a time and the values are written
+        in chunks, so it is never all in memory.
+        """
+        fd, name = tempfile.mkstemp(dir=self.path, prefix=".new-")
+        tmp = Path(name)
+        ncols = 0
+        blank = False
+        values = array("d")
+        try:
+            with os.fdopen(fd, "wb") as out, filename.open() as f:
+                for line in f:
+                    fields = line.split()
+                    if not fields:
+                        blank = True
+                        continue
+                    if fields[0].startswith("#"):
+                        continue
+                    # A blank line separates blocks of data, only
+                    # trailing blank lines are allowed
+                    if blank or (ncols and len(fields) != ncols):
+                        raise ValueError("Not a single block of data")
+                    ncols = len(fields)
+                    values.extend(map(float, fields))
+                    if len(values) >= CHUNK_SIZE:
+                        values.tofile(out)
+                        del values[:]
+                values.tofile(out)
+        except (OSError, UnicodeDecodeError, ValueError):
+            ncols = 0
+
+        if not ncols:
+            tmp.unlink()
+            copy = self.path / f"{key}.none"
+            copy.touch()
+            return copy
+
+        copy = self.path / f"{key}.{ncols}.bin"
+        tmp.replace(copy)
+        return copy
+
+
+def split_ranges(element: str) -> tuple[str, str] | None:
+    """
+    Split the leading ranges, e.g. [0:1][], off a plot element
+
+    Returns the ranges, with the space around them, and the rest of
+    the element. None if a range is not closed.
+    """
+    stripped = element.lstrip()
+    prefix = element[: len(element) - len(stripped)]
+    while stripped.startswith("["):
+        end = stripped.find("]")
+        if end < 0:
+            return None
+        rest = stripped[end + 1 :].lstrip()
+        prefix += stripped[: len(stripped) - len(rest)]
+        stripped = rest
+    return prefix, stripped
+
+
+def name_previous_files(elements: list[str]) -> list[str]:
+    """
+    Replace '' in plot elements with the name of the previous file
+
+    '' reads the previous data file, or datablock, of the statement
+    again. Naming the file lets each element be rewritten on its
+    own, after the previous file has been replaced by a copy.
+    """
+    result = []
+    previous = None
+    for element in elements:
+        parts = split_ranges(element)
+        m = QUOTED_NAME_RE.match(parts[1]) if parts else None
+        if parts and m:
+            prefix, stripped = parts
+            if not m.group("name"):
+                if previous:
+                    element = f"{prefix}{previous}{stripped[m.end() :]}"
+            elif FILENAME_RE.match(stripped):
+                previous = m.group()
+            else:
+                # Inline data or a command
+                previous = None
+        elif parts and (m := DATABLOCK_NAME_RE.match(parts[1])):
+            previous = m.group()
+        result.append(element)
+    return result
+
+
+def split_elements(text: str) -> list[str]:
+    """
+    Split the list of things to plot at the top level commas
+
+    Commas in quotes, brackets and parentheses do not split.
+    """
+    elements = []
+    depth = 0
+    quote = ""
+    start = 0
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = ""
+        elif char in "'\"":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            elements.append(text[start:i])
+            start = i + 1
+    elements.append(text[start:])
+    return elements
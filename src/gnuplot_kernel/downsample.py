@@ -0,0 +1,363 @@
+"""
+Fewer points for plots with more points than pixels
+
+A line with many points per pixel column is drawn as a vertical
+stroke from the lowest to the highest point in the column. Keeping
+the first, last, lowest and highest point of each pixel column
+(M4 downsampling) draws the same picture with at most four points
+per column.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import re
+import sys
+import tempfile
+import warnings
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .datacache import (
+    DATABLOCK_NAME_RE,
+    FILENAME_RE,
+    UNSUPPORTED_RE,
+    name_previous_files,
+    split_elements,
+)
+from .replwrap import START_DATABLOCK_RE
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    import numpy as np  # pyright: ignore[reportMissingImports]
+
+# plot statements, not splot
+PLOT_CMD_RE = re.compile(r"^(?P<cmd>\s*(?:plot|plo|pl|p)\b\s*)")
+
+# A using specification of two columns e.g "using 1:2". Column 0
+# is the number of the point, not a column of the data.
+XY_USING_RE = re.compile(
+    r"\b(?:using|usin|usi|us|u)\s+([1-9]\d*):([1-9]\d*)(?=\s|$)"
+)
+
+# The columns are pixel columns of the range of the data, so the
+# x axis has to be linear and autoscaled. These statements of a cell
+# may change that.
+SET_XAXIS_RE = re.compile(
+    r"\bset\s+(?:xr|xra|xran|xrang|xrange|log\w*|nonlinear|xdata)\b"
+)
+
+# An x axis that is autoscaled and linear, in the output of save set
+XRANGE_AUTO_RE = re.compile(r"(?m)^set xrange \[\s*\*\s*:\s*\*\s*\]")
+XAXIS_NONLINEAR_RE = re.compile(
+    r"(?m)^set (?:logscale x|nonlinear x|xdata time)\b"
+)
+
+# A range that does not limit, e.g. [], [:] or [t=*:*]
+OPEN_RANGE_RE = re.compile(r"^\[\s*(?:\w+\s*=)?[\s*]*(?::[\s*]*)?\]$")
+
+# Smoothing is computed from all the points, not only from those
+# that are drawn
+SMOOTH_RE = re.compile(r"\b(?:smooth|smoot|smoo|smo|sm|s)\b")
+
+# Points joined by lines, only these are downsampled
+WITH_LINES_RE = re.compile(r"\b(?:with|wit|wi|w)\s+(?:lines|line|lin|li|l)\b")
+
+COMMENT_RE = re.compile(r"(?m)^\s*#.*$")
+BLANK_LINE_RE = re.compile(r"\n\s*\n")
+
+
+class Downsampler:
+    """
+    Downsample the data of the plot statements in a cell
+
+    Only the lines (with lines) of two columns, of data files and
+    datablocks with more than threshold points per pixel column,
+    whose x values are in order, are downsampled. The pixel columns
+    span the range of the data, so lines are not downsampled when
+    the x axis is not autoscaled or not linear.
+
+    The downsampled data is written to binary files named by a key
+    of the data, so running a cell again reuses them.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the downsampled data
+    width : int
+        Width of the plot in pixels
+    threshold : int
+        Number of points per pixel column above which the data is
+        downsampled.
+    datablocks : dict[str, str]
+        Datablocks of the session by name, as recorded by the
+        wrapper.
+    settings : callable
+        Returns the settings of the session, as written by save set,
+        or None if they are not known. It is called when the first
+        line that can be downsampled is found.
+    cwd : callable
+        Returns the working directory of gnuplot, which relative
+        file names are relative to. If it returns None, files with
+        relative names are not downsampled.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        width: int,
+        threshold: int,
+        datablocks: dict,
+        settings: Callable[[], str | None],
+        cwd: Callable[[], Path | None] = lambda: None,
+    ):
+        self.path = path
+        self.width = width
+        self.threshold = threshold
+        self.datablocks = datablocks
+        self.settings = settings
+        self.cwd = cwd
+        self._xaxis_ok: bool | None = None
+        self.reports: list[str] = []
+
+    def rewrite(self, code: str) -> str:
+        """
+        Make the plot statements of a cell plot downsampled data
+        """
+        if SET_XAXIS_RE.search(code):
+            return code
+
+        lines = []
+        end_string = ""
+        for line in code.splitlines():
+            if end_string:
+                if line == end_string:
+                    end_string = ""
+            elif m := START_DATABLOCK_RE.match(line):
+                end_string = m.group("end")
+            elif m := PLOT_CMD_RE.match(line):
+                elements = name_previous_files(split_elements(line[m.end() :]))
+                line = m.group("cmd") + ",".join(
+                    self._rewrite_element(e) for e in elements
+                )
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _rewrite_element(self, element: str) -> str:
+        """
+        Replace the data of a plot element with downsampled data
+        """
+        # Leading ranges, e.g. [0:1][]
+        stripped = element.lstrip()
+        prefix = element[: len(element) - len(stripped)]
+        while stripped.startswith("["):
+            end = stripped.find("]")
+            if end < 0:
+                return element
+            # The first range is the x range
+            if not prefix.strip() and not OPEN_RANGE_RE.match(
+                stripped[: end + 1]
+            ):
+                return element
+            rest = stripped[end + 1 :].lstrip()
+            prefix += stripped[: len(stripped) - len(rest)]
+            stripped = rest
+
+        if m := FILENAME_RE.match(stripped):
+            name = m.group("name")
+            filename = Path(name)
+            if not filename.is_absolute():
+                if (directory := self.cwd()) is None:
+                    return element
+                filename = directory / filename
+            source = _file_source(filename)
+        elif m := DATABLOCK_NAME_RE.match(stripped):
+            name = m.group()
+            source = _datablock_source(self.datablocks.get(name))
+        else:
+            return element
+
+        modifiers = stripped[m.end() :]
+        using = XY_USING_RE.search(modifiers)
+        if (
+            source is None
+            or not using
+            or not WITH_LINES_RE.search(modifiers)
+            or UNSUPPORTED_RE.search(modifiers)
+            or SMOOTH_RE.search(modifiers)
+            or not self._xaxis_autoscaled()
+        ):
+            return element
+
+        key_text, read = source
+        key = hashlib.sha256(
+            f"{key_text}:{using.groups()}:{self.width}".encode()
+        ).hexdigest()
+        filename = next(self.path.glob(f"{key}-*.bin"), None)
+        if filename is None:
+            filename = self._downsample(key, read(), *using.groups())
+        if filename is None:
+            return element
+
+        # <key>-<number of points before>-<number of points after>.bin
+        before, after = filename.stem.split("-")[1:]
+        self.reports.append(
+            f"Downsampled {name} from {int(before):,} to {int(after):,} "
+            "points."
+        )
+        spec = (
+            f"'{filename}' binary record={after} "
+            f"format='%float64%float64' endian={sys.byteorder}"
+        )
+        modifiers = (
+            modifiers[: using.start()] + "using 1:2" + modifiers[using.end() :]
+        )
+        return f"{prefix}{spec}{modifiers}"
+
+    def _xaxis_autoscaled(self) -> bool:
+        """
+        Return whether the x axis is autoscaled and linear
+        """
+        if self._xaxis_ok is None:
+            settings = self.settings()
+            self._xaxis_ok = bool(
+                settings
+                and XRANGE_AUTO_RE.search(settings)
+                and not XAXIS_NONLINEAR_RE.search(settings)
+            )
+        return self._xaxis_ok
+
+    def _downsample(
+        self, key: str, text: str | None, xcol: str, ycol: str
+    ) -> Path | None:
+        """
+        Downsample text data and write it to a binary file
+
+        Returns the file, or None if the data is not downsampled.
+        """
+        data = parse_columns(text) if text else None
+        if data is None or len(data) <= self.threshold * self.width:
+            return None
+
+        i, j = int(xcol) - 1, int(ycol) - 1
+        if max(i, j) >= data.shape[1]:
+            return None
+
+        xy = downsample_m4(data[:, i], data[:, j], self.width)
+        if xy is None:
+            return None
+
+        filename = self.path / f"{key}-{len(data)}-{len(xy)}.bin"
+        with tempfile.NamedTemporaryFile(
+            dir=self.path, prefix=".new-", delete=False
+        ) as f:
+            xy.tofile(f)
+        Path(f.name).replace(filename)
+        return filename
+
+
+def _file_source(filename: Path):
+    """
+    Return a key of a data file and a function to read it
+    """
+    try:
+        st = filename.stat()
+    except OSError:
+        return None
+
+    def read():
+        with contextlib.suppress(OSError, UnicodeDecodeError):
+            return filename.read_text()
+
+    key_text = f"{filename.resolve()}:{st.st_size}:{st.st_mtime_ns}"
+    return key_text, read
+
+
+def _datablock_source(block: str | None):
+    """
+    Return a key of a datablock and a function to read its data
+    """
+    if not block:
+        return None
+
+    def read():
+        # Without the first and last lines
+        text = block.split("\n", 1)[1].rstrip()
+        return text.rpartition("\n")[0]
+
+    return hashlib.sha256(block.encode()).hexdigest(), read
+
+
+def parse_columns(text: str) -> np.ndarray | None:
+    """
+    Parse text data into an array with a column for each column
+
+    Returns None if the text is not a single block of numbers with
+    the same number of columns in every row.
+    """
+    import numpy as np  # pyright: ignore[reportMissingImports]
+
+    text = COMMENT_RE.sub("", text).strip()
+    if not text or BLANK_LINE_RE.search(text):
+        return None
+
+    nrows = text.count("\n") + 1
+    ncols = len(text.partition("\n")[0].split())
+    with warnings.catch_warnings():
+        # numpy warns when it cannot parse all of the text
+        warnings.simplefilter("ignore", DeprecationWarning)
+        values = np.fromstring(text, sep=" ")
+
+    if values.size != nrows * ncols:
+        return None
+    return values.reshape(nrows, ncols)
+
+
+def downsample_m4(
+    x: np.ndarray, y: np.ndarray, width: int
+) -> np.ndarray | None:
+    """
+    Keep the first, last, lowest and highest point of each column
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        x values, in increasing order
+    y : numpy.ndarray
+        y values
+    width : int
+        Number of pixel columns
+
+    Returns
+    -------
+    out : numpy.ndarray | None
+        Array of two columns, x and y of the points that are kept.
+        None if x is not in order or there are missing values.
+    """
+    import numpy as np  # pyright: ignore[reportMissingImports]
+
+    n = len(x)
+    if (np.diff(x) < 0).any() or np.isnan(x).any() or np.isnan(y).any():
+        return None
+
+    span = (x[-1] - x[0]) or 1
+    columns = ((x - x[0]) * (width / span)).astype(np.int64)
+    np.minimum(columns, width - 1, out=columns)
+
+    # The points of a column are next to each other
+    starts = np.flatnonzero(np.diff(columns)) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.concatenate((starts[1:], [n])) - 1
+    counts = ends - starts + 1
+    group = np.repeat(np.arange(len(starts)), counts)
+    index = np.arange(n)
+
+    ymin = np.minimum.reduceat(y, starts)
+    ymax = np.maximum.reduceat(y, starts)
+    imin = np.minimum.reduceat(np.where(y == ymin[group], index, n), starts)
+    imax = np.minimum.reduceat(np.where(y == ymax[group], index, n), starts)
+
+    keep = np.unique(np.concatenate((starts, imin, imax, ends)))
+    return np.column_stack((x[keep], y[keep]))
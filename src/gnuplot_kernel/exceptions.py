@@ -2,3 +2,9 @@ class GnuplotError(Exception):
     def __init__(self, message):
         self.args = (message,)
         self.message = message
+
+
+class GnuplotExited(GnuplotError):
+    """
+    The gnuplot process exited while the kernel waited on it
+    """
@@ -1,23 +1,99 @@
 from __future__ import annotations
 
+import atexit
 import contextlib
+import functools
+import json
+import os
+import re
+import shutil
 import sys
+import tempfile
 import uuid
-from itertools import chain
 from pathlib import Path
-from typing import cast
+from typing import TYPE_CHECKING, cast
 
-from IPython.display import SVG, Image
+from IPython.display import SVG, Image, Javascript
 from metakernel import MetaKernel, ProcessMetaKernel, pexpect
-from metakernel.process_metakernel import TextOutput
+from traitlets import Bool, Enum, Float, Int, Unicode, observe
 
+from .cache import RenderCache, cell_key, is_plot_only
+from .capture import ImageCapture
+from .datacache import BinaryDataCache
+from .downsample import Downsampler
 from .exceptions import GnuplotError
-from .replwrap import PROMPT_RE, PROMPT_REMOVE_RE, GnuplotREPLWrapper
+from .pool import WrapperPool
+from .postprocess import (
+    minify_svg,
+    rasterize_svg,
+    recompress_png,
+    svg_element_count,
+)
+from .publisher import ImagePublisher
+from .replwrap import (
+    PROMPT_RE,
+    PROMPT_REMOVE_RE,
+    START_DATABLOCK_RE,
+    GnuplotREPLWrapper,
+)
+from .spawn import PipeSpawn
 from .statement import STMT
+from .table import FifoReader, parse_table
 from .utils import get_version
 
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from metakernel.process_metakernel import TextOutput
+
 IMG_COUNTER = "__gpk_img_index"
+# The image counter in the saved state of the session
+IMG_COUNTER_STATE_RE = re.compile(rf"(?m)^{IMG_COUNTER} = .*\n?")
 IMG_COUNTER_FMT = "%03d"
+DEFAULT_TERMSPEC = 'pngcairo size 385, 256 font "Arial,10"'
+
+# Shared memory, the images need not touch the disk
+SHM_DIR = "/dev/shm"
+
+# gnuplot names of the binary types of NumPy arrays, by dtype kind
+# and size
+BINARY_FORMATS = {
+    **{("f", n): f"%float{8 * n}" for n in (4, 8)},
+    **{("i", n): f"%int{8 * n}" for n in (1, 2, 4, 8)},
+    **{("u", n): f"%uint{8 * n}" for n in (1, 2, 4, 8)},
+}
+
+VARIABLE_NAME_RE = re.compile(r"^[A-Za-z_]\w*$")
+
+# Statements that may change the working directory of gnuplot
+CHDIR_RE = re.compile(r"(?m)(?:^|[;{])\s*(?:cd|l|lo|loa|load|ca|cal|call)\b")
+
+# Width in pixels of the terminal, e.g. "size 385, 256"
+TERM_WIDTH_RE = re.compile(r"\bsize\s+(\d+)\s*,")
+DEFAULT_TERM_WIDTH = 640
+
+# The comm over which images are sent as raw bytes, and the renderer
+# that opens it in the frontend. The renderer puts each image in the
+# <img> element that is displayed in its place, and acknowledges it.
+IMAGE_COMM_TARGET = "gnuplot_kernel.images"
+IMAGE_RENDERER_JS = f"""
+(function () {{
+  const kernel = window.Jupyter && Jupyter.notebook && Jupyter.notebook.kernel;
+  if (!kernel) {{
+    return;
+  }}
+  const comm = kernel.comm_manager.new_comm("{IMAGE_COMM_TARGET}", {{}});
+  comm.on_msg(function (msg) {{
+    const content = msg.content.data;
+    const img = document.getElementById(content.id);
+    if (img) {{
+      const blob = new Blob([msg.buffers[0]], {{type: content.mimetype}});
+      img.src = URL.createObjectURL(blob);
+    }}
+    comm.send({{id: content.id}});
+  }});
+}})();
+"""
 
 
 class GnuplotKernel(ProcessMetaKernel):
@@ -50,14 +126,343 @@ class GnuplotKernel(ProcessMetaKernel):
         "name": "gnuplot",
     }
 
+    batch_execution = Bool(
+        False,
+        help=(
+            "Send each cell to gnuplot in a single round trip instead "
+            "of statement by statement. Cells with statements that "
+            "wait on the user (help, pause) always run statement by "
+            "statement."
+        ),
+    ).tag(config=True)
+
+    stream_output = Bool(
+        False,
+        help=(
+            "Send the output of gnuplot to the notebook as it "
+            "arrives instead of when the cell has finished."
+        ),
+    ).tag(config=True)
+
+    stream_flush_interval = Float(
+        0.1,
+        help=(
+            "Maximum time (in seconds) for which streamed output "
+            "is held back before it is sent to the notebook."
+        ),
+    ).tag(config=True)
+
+    search_window = Int(
+        4096,
+        help=(
+            "Number of characters at the end of the output of gnuplot "
+            "that are searched again for the prompt when more output "
+            "arrives. It only has to be longer than the prompt."
+        ),
+    ).tag(config=True)
+
+    read_size = Int(
+        65536,
+        help="Maximum number of characters read from gnuplot at a time.",
+    ).tag(config=True)
+
+    output_limit = Int(
+        10_000_000,
+        help=(
+            "Maximum number of characters of the output of a cell "
+            "that are kept in memory. Past it, the output goes to a "
+            "temporary file and the notebook shows the start of the "
+            "output and the name of the file. The file is deleted "
+            "when the kernel shuts down."
+        ),
+    ).tag(config=True)
+
+    transport = Enum(
+        ["pty", "pipe"],
+        "pty",
+        help=(
+            "How to talk to gnuplot. With 'pty', gnuplot runs in a "
+            "terminal and the kernel reads up to its prompt. With "
+            "'pipe', gnuplot reads from a pipe and the kernel reads "
+            "up to a marker printed after every statement. There "
+            "is then no echo of the input to filter out. gnuplot "
+            "reads the pipe as interactive input ('gnuplot -'), so "
+            "an error does not end the session, and its stdout is "
+            "line buffered (with stdbuf, if available) to keep the "
+            "output in order. Takes effect when gnuplot is "
+            "(re)started."
+        ),
+    ).tag(config=True)
+
+    pool_size = Int(
+        1,
+        help=(
+            "Number of gnuplot processes that are started ahead of "
+            "time, so that starting and restarting the kernel does "
+            "not wait on gnuplot. If 0, gnuplot is started when it "
+            "is needed."
+        ),
+    ).tag(config=True)
+
+    auto_checkpoint = Bool(
+        False,
+        help=(
+            "Save a checkpoint of the gnuplot session after every "
+            "cell that runs without error. When gnuplot is "
+            "restarted, the session is restored from the last "
+            "checkpoint."
+        ),
+    ).tag(config=True)
+
+    checkpoint_file = Unicode(
+        "",
+        help=(
+            "File in which checkpoints are also saved. If it exists "
+            "when the kernel starts, the session is restored from "
+            "it. If empty, checkpoints are only kept in memory."
+        ),
+    ).tag(config=True)
+
+    interrupt_timeout = Float(
+        5.0,
+        help=(
+            "Maximum time (in seconds) that gnuplot has to stop "
+            "after an interrupt. After it, gnuplot is killed and "
+            "started again."
+        ),
+    ).tag(config=True)
+
+    respawn = Bool(
+        True,
+        help=(
+            "Start a new gnuplot process when gnuplot exits "
+            "unexpectedly, and restore the session from the last "
+            "checkpoint. Without a checkpoint, only the datablocks "
+            "and plot settings are restored."
+        ),
+    ).tag(config=True)
+
+    progressive_display = Bool(
+        True,
+        help=(
+            "Display the inline images of a cell as soon as gnuplot "
+            "has finished them, instead of when the cell has "
+            "finished."
+        ),
+    ).tag(config=True)
+
+    image_transport = Enum(
+        ["display", "comm"],
+        default_value="display",
+        help=(
+            "How inline PNG and JPEG images are sent to the frontend. "
+            "'display': base64 encoded in the display data. 'comm': "
+            "as raw bytes over a comm, to a small renderer that the "
+            "kernel installs. The renderer only runs in the classic "
+            "notebook (Jupyter.notebook), JupyterLab and Notebook 7 "
+            "always fall back to 'display'. Until the renderer has "
+            "opened the comm, and while it does not acknowledge the "
+            "images, they are displayed as with 'display'. Images "
+            "sent over the comm are not saved in the notebook."
+        ),
+    ).tag(config=True)
+
+    image_capture = Enum(
+        ["file", "fifo"],
+        default_value="file",
+        help=(
+            "How inline images get from gnuplot to the kernel. "
+            "'file': gnuplot writes each image to a file in the "
+            "image directory, the kernel reads the file and deletes "
+            "it. 'fifo': gnuplot writes the images to two named "
+            "pipes in the image directory, taking turns, and the "
+            "kernel reads them straight into memory. No image is "
+            "stored in a file."
+        ),
+    ).tag(config=True)
+
+    image_dir = Unicode(
+        "",
+        help=(
+            "Directory in which gnuplot writes inline images. If "
+            "empty, the kernel creates a directory of its own in "
+            f"{SHM_DIR} (memory) if it is available, or else in the "
+            "temporary directory."
+        ),
+    ).tag(config=True)
+
+    png_compress_level = Int(
+        -1,
+        help=(
+            "zlib level (0-9) at which inline PNG images are "
+            "compressed again before they are displayed. If -1, "
+            "they are displayed as gnuplot writes them."
+        ),
+    ).tag(config=True)
+
+    svg_precision = Int(
+        -1,
+        help=(
+            "Number of decimal places to which the coordinates of "
+            "inline SVG images are rounded, the images are also "
+            "stripped of indentation. If -1, they are displayed as "
+            "gnuplot writes them."
+        ),
+    ).tag(config=True)
+
+    svg_max_size = Int(
+        5_000_000,
+        help=(
+            "Size in bytes above which an inline SVG image is "
+            "displayed as a PNG image, the browser is slow to "
+            "render large SVG images. If 0, there is no maximum. "
+            "Requires cairosvg, the raster extra."
+        ),
+    ).tag(config=True)
+
+    svg_max_elements = Int(
+        50_000,
+        help=(
+            "Number of elements above which an inline SVG image is "
+            "displayed as a PNG image. If 0, there is no maximum. "
+            "Requires cairosvg, the raster extra."
+        ),
+    ).tag(config=True)
+
+    max_images = Int(
+        100,
+        help=(
+            "Maximum number of inline images displayed for a cell. "
+            "The first max_images - 1 images and the last image of "
+            "the cell are displayed, and the number of images left "
+            "out is printed. If 0, there is no maximum."
+        ),
+    ).tag(config=True)
+
+    hidden_image_dir = Unicode(
+        "",
+        help=(
+            "Directory in which to keep the images that are left "
+            "out by max_images. If empty, they are deleted."
+        ),
+    ).tag(config=True)
+
+    render_cache_dir = Unicode(
+        "",
+        help=(
+            "Directory of a cache of the inline images of cells. When "
+            "a cell that only plots is run again with the same "
+            "settings, data files and session state, its images are "
+            "displayed from the cache and gnuplot does not draw them. "
+            "GPVAL_ variables and replot then refer to the last plot "
+            "that gnuplot drew. Only the images that were displayed "
+            "are cached, those left out by max_images are not. If "
+            "empty, there is no cache."
+        ),
+    ).tag(config=True)
+
+    render_cache_size = Int(
+        500_000_000,
+        help=(
+            "Maximum size in bytes of the render cache. The images of "
+            "the cells that were run least recently are removed to "
+            "keep the cache within it."
+        ),
+    ).tag(config=True)
+
+    data_cache_dir = Unicode(
+        "",
+        help=(
+            "Directory of binary copies of the text data files that "
+            "are plotted. When a plot, splot or stats statement with "
+            "a using specification reads a file of numbers, gnuplot "
+            "reads a copy of the file in binary format, which it "
+            "does not have to parse. The copy is made the first time "
+            "and again when the file changes. If empty, the data "
+            "files are read as they are."
+        ),
+    ).tag(config=True)
+
+    downsample = Bool(
+        False,
+        help=(
+            "Downsample the lines of plots that have many more points "
+            "than the plot has pixel columns. Of the points in each "
+            "pixel column, only the first, last, lowest and highest "
+            "are plotted, which draws the same line. Only applies to "
+            "inline plots of data files and datablocks plotted with "
+            "'using X:Y with lines', whose x values are in order. "
+            "Requires numpy, the numpy extra. The %%downsample magic "
+            "turns it on or off for a cell."
+        ),
+    ).tag(config=True)
+
+    downsample_threshold = Int(
+        20,
+        help=(
+            "Number of points per pixel column above which a line is "
+            "downsampled."
+        ),
+    ).tag(config=True)
+
     inline_plotting = True
     reset_code = ""
     _first = True
     _image_files: list[Path] = []
+    # The image files that have been queued for display, the
+    # number of images queued or left out, and the ones left out
+    _published: set[Path] = set()
+    _image_count = 0
+    _hidden_images: list[Path | bytes] = []
+    # Reads the images of the running cell, when they are captured
+    # through FIFOs
+    _capture: ImageCapture | None = None
+    # The render cache, and the entry into which the images of the
+    # running cell are copied
+    _render_cache: RenderCache | None = None
+    _cache_entry: Path | None = None
+    _data_cache: BinaryDataCache | None = None
+    # Whether to downsample the running cell, if not the default,
+    # and the directory of the downsampled data
+    _downsample_cell: bool | None = None
+    _downsample_dir: Path | None = None
+    # The FIFO to which set table writes for pull_table
+    _table_fifo: Path | None = None
+    # Files of the arrays pushed into the session, by variable name
+    _pushed: dict[str, Path]
+    # Files with the full output of cells, past output_limit
+    _output_files: list[Path]
+    _image_dir: Path | None = None
+    # Whether the kernel created the image directory
+    _own_image_dir = False
     _error = False
 
     wrapper: GnuplotREPLWrapper
     _bad_prompts: set = set()
+    _pool: WrapperPool
+    _publisher: ImagePublisher
+    _checkpoint: dict | None = None
+    # The comm opened by the image renderer, and the ids of the
+    # images sent over it that it has not acknowledged
+    _image_comm = None
+    _unacked_images: set[str]
+    _warned_heavy_svg = False
+    _renderer_installed = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = WrapperPool(self.start_gnuplot, self.pool_size)
+        self._pushed = {}
+        self._output_files = []
+        self._unacked_images = set()
+        # Also when the kernel exits without a shutdown
+        atexit.register(self.remove_session_files)
+        self._publisher = ImagePublisher(
+            self.display_image, self.postprocess_image
+        )
+        self.comm_manager.register_target(
+            IMAGE_COMM_TARGET, self._open_image_comm
+        )
 
     def check_prompt(self):
         """
@@ -66,6 +471,10 @@ class GnuplotKernel(ProcessMetaKernel):
         A bad prompt is one that does not contain the string 'gnuplot>'.
         The warning is printed once per bad prompt.
         """
+        # There is no prompt on the pipe transport
+        if self.wrapper.piped:
+            return
+
         prompt = cast("str", self.wrapper.prompt)
         if "gnuplot>" not in prompt and prompt not in self._bad_prompts:
             print(f"Warning: The prompt is currently set to '{prompt}'")
@@ -89,25 +498,85 @@ class GnuplotKernel(ProcessMetaKernel):
             self._first = False
             self.handle_plot_settings()
 
+        cwd = self.gnuplot_cwd_getter(code)
+        key = None
+        if self.inline_plotting and (cache := self.get_render_cache()):
+            key = self.render_cache_key(code, cwd)
+            if key and (images := cache.get(key)) is not None:
+                self.display_cached_images(images)
+                if self.reset_code:
+                    super().do_execute_direct(self.reset_code, silent=True)
+                self.check_prompt()
+                return None
+            if key:
+                self._cache_entry = cache.new_entry()
+
+        downsample = self.downsample
+        if self._downsample_cell is not None:
+            downsample = self._downsample_cell
+            self._downsample_cell = None
+
+        if self.inline_plotting and downsample:
+            code = self.downsample_code(code, cwd)
+
+        if self.data_cache_dir:
+            code = self.get_data_cache().rewrite(code, cwd)
+
         if self.inline_plotting:
+            # A cell that raised may have left its reader behind
+            if self._capture:
+                self._capture.close()
+                self._capture = None
+            if self.image_capture == "fifo":
+                self._capture = ImageCapture(self.get_image_dir())
             code = self.add_inline_image_statements(code)
+            if self.image_transport == "comm":
+                self.install_image_renderer()
 
-        success = True
+        # metakernel reports the errors of gnuplot, they are not
+        # raised. The wrapper keeps the error of the cell.
+        result = super().do_execute_direct(code, silent=not self.stream_output)
+        success = self.wrapper.error is None
 
-        try:
-            result = super().do_execute_direct(code, silent=True)
-        except GnuplotError as e:
-            result = TextOutput(e.message)
+        if path := self.wrapper.output_path:
+            self._output_files.append(path)
+
+        # The images of an interrupted cell are incomplete
+        if self.wrapper.interrupted:
             success = False
 
+        if not self.wrapper.child.isalive():
+            success = False
+            if self.respawn:
+                self.respawn_gnuplot()
+
+        if capture := self._capture:
+            # After an error, the output of the image that was being
+            # plotted is still open. gnuplot has to close it for the
+            # reader to see the end of the image.
+            with contextlib.suppress(GnuplotError):
+                self.wrapper.run_command("unset output")
+            capture.close()
+
         if self.reset_code:
             super().do_execute_direct(self.reset_code, silent=True)
 
+        if success and self.auto_checkpoint:
+            self.save_checkpoint()
+
         if self.inline_plotting:
             if success:
                 self.display_images()
             self.delete_image_files()
 
+        if entry := self._cache_entry:
+            self._cache_entry = None
+            cache = cast("RenderCache", self._render_cache)
+            if success and key:
+                cache.add(key, entry)
+            else:
+                cache.discard(entry)
+
         self.check_prompt()
 
         # No empty strings
@@ -117,19 +586,33 @@ class GnuplotKernel(ProcessMetaKernel):
         """
         Add 'set output ...' before every plotting statement
 
-        This is what powers inline plotting
+        This is what powers inline plotting. If the terminal
+        animates (e.g. 'gif animate'), there is one 'set output'
+        for the whole cell, so that all the plots are frames of
+        one image.
         """
 
         # "set output sprintf('foobar.%d.png', counter);"
         # "counter=counter+1"
-        def set_output_inline(lines):
+        def set_output_inline(lines, index):
+            if self._capture:
+                # The previous output is closed before the next FIFO
+                # is opened
+                tpl = self._capture.template
+                cmd = (
+                    f"unset output; set output sprintf('{tpl}', "
+                    f"{IMG_COUNTER} % 2);{IMG_COUNTER}={IMG_COUNTER}+1"
+                )
+                lines.insert(index, cmd)
+                return
+
             tpl = self.get_image_filename()
             if tpl:
                 cmd = (
                     f"set output sprintf('{tpl}', {IMG_COUNTER});"
                     f"{IMG_COUNTER}={IMG_COUNTER}+1"
                 )
-                lines.append(cmd)
+                lines.insert(index, cmd)
 
         # We automatically create an output file for the following
         # cases if the user has not created one.
@@ -137,10 +620,35 @@ class GnuplotKernel(ProcessMetaKernel):
         #      multiplot block
         #    - before every multiplot block
 
+        #
+        # When animating, the output is created once, before the
+        # first statement that plots. If that statement is a block,
+        # e.g. a do-for loop, the output is created before the
+        # block so that it is not created for each iteration.
+
+        termspec = self.plot_settings.get("termspec") or ""
+        animate = "animate" in termspec.split()
+        animating = False
         lines = []
         sm = StateMachine()
         is_joined_stmt = False
+        # Brace depth and index of the line that starts the current
+        # top level statement
+        depth = top = 0
+        # The lines of a datablock are data, they are passed on
+        # without being looked at
+        end_string = ""
         for line in code.splitlines():
+            if end_string:
+                lines.append(line)
+                if line == end_string:
+                    end_string = ""
+                continue
+            elif m := START_DATABLOCK_RE.match(line):
+                end_string = m.group("end")
+                lines.append(line)
+                continue
+
             stmt = STMT(line)
             sm.transition(stmt)
             add_inline_plot = (
@@ -148,15 +656,25 @@ class GnuplotKernel(ProcessMetaKernel):
                 in (("none", "plot"), ("none", "multiplot"), ("plot", "plot"))
                 and not is_joined_stmt
             )
-            if add_inline_plot:
-                set_output_inline(lines)
+            if depth == 0 and not is_joined_stmt:
+                top = len(lines)
+
+            if add_inline_plot and not animate:
+                set_output_inline(lines, len(lines))
+            elif add_inline_plot and not animating:
+                set_output_inline(lines, top)
+                animating = True
 
             lines.append(stmt)
             is_joined_stmt = stmt.strip().endswith("\\")
+            depth = max(depth + stmt.brace_balance(), 0)
 
         # Make gnuplot flush the output
         if not lines[-1].endswith("\\"):
             lines.append("unset output")
+        # The first image goes to the first FIFO
+        if self._capture:
+            lines.insert(0, f"{IMG_COUNTER}=0")
         code = "\n".join(lines)
         return code
 
@@ -171,68 +689,459 @@ class GnuplotKernel(ProcessMetaKernel):
         # Later on when we check if the file exists we know
         # whodunnit.
         fmt = self.plot_settings["format"]
-        filename = Path(
-            f"/tmp/gnuplot-inline-{uuid.uuid1()}.{IMG_COUNTER_FMT}.{fmt}"
+        filename = (
+            self.get_image_dir()
+            / f"gnuplot-inline-{uuid.uuid1()}.{IMG_COUNTER_FMT}.{fmt}"
         )
         self._image_files.append(filename)
         return filename
 
+    def get_image_dir(self) -> Path:
+        """
+        Return the directory in which gnuplot writes inline images
+
+        Only the images of the kernel are in it, so finding the
+        images of a cell takes time proportional to their number.
+        """
+        if self._image_dir is None:
+            if self.image_dir:
+                path = Path(self.image_dir)
+                path.mkdir(parents=True, exist_ok=True)
+            else:
+                parent = SHM_DIR if os.access(SHM_DIR, os.W_OK) else None
+                path = Path(
+                    tempfile.mkdtemp(prefix="gnuplot-kernel-", dir=parent)
+                )
+            self._image_dir = path
+            self._own_image_dir = not self.image_dir
+        return self._image_dir
+
+    @observe("image_dir")
+    def _observe_image_dir(self, change):
+        self.remove_image_dir()
+
+    def remove_image_dir(self):
+        """
+        Remove the image directory if the kernel created it
+        """
+        if self._image_dir and self._own_image_dir:
+            shutil.rmtree(self._image_dir, ignore_errors=True)
+        self._image_dir = None
+
     def iter_image_files(self):
         """
         Iterate over the image files
+
+        The images are in the order of the plot statements that
+        created them.
         """
-        it = chain(
-            *[
-                sorted(f.parent.glob(f.name.replace(IMG_COUNTER_FMT, "*")))
-                for f in self._image_files
-            ]
-        )
-        return it
+        if not self._image_files:
+            return iter([])
+
+        # The files of a template, "<stem>.%03d.<fmt>", differ in
+        # the image counter
+        stems = [f.name.partition(".")[0] for f in self._image_files]
+        order = {stem: i for i, stem in enumerate(stems)}
+        files = []
+        with os.scandir(self._image_files[0].parent) as it:
+            for entry in it:
+                stem, _, rest = entry.name.partition(".")
+                if (i := order.get(stem)) is not None:
+                    index = int(rest.partition(".")[0])
+                    files.append((i, index, Path(entry.path)))
 
-    def display_images(self):
+        return (path for *_, path in sorted(files))
+
+    def display_images(self, final=True):
         """
         Display images if gnuplot wrote to them
+
+        The images are queued to be read, displayed and deleted by
+        a background thread, so gnuplot can go on with the cell
+        while they are being sent to the frontend.
+
+        Parameters
+        ----------
+        final : bool
+            If False, the cell is still running. gnuplot may still
+            be writing the last image, it is left for later. The
+            images before it are done, gnuplot closes an output
+            before it opens the next one.
+
+        Notes
+        -----
+        At most max_images images are displayed for a cell, the
+        first max_images - 1 and the last image of the cell.
+        """
+        if not self.inline_plotting:
+            return
+
+        fmt = self.plot_settings["format"]
+        images: list[Path | bytes]
+        if self._capture:
+            images = list(self._capture.images)
+        else:
+            images = list(self.iter_image_files())
+        if not final:
+            images = images[:-1]
+
+        if self._capture:
+            images = images[self._image_count :]
+        else:
+            images = [f for f in images if f not in self._published]
+            self._published.update(cast("list[Path]", images))
+
+        last = images[-1] if final and images else None
+        for image in images:
+            self._image_count += 1
+            n = self._image_count
+            if 0 < self.max_images <= n and image is not last:
+                self._hidden_images.append(image)
+                continue
+
+            if self._cache_entry:
+                cached = self._cache_entry / f"{n:06d}.{fmt}"
+                if isinstance(image, bytes):
+                    cached.write_bytes(image)
+                else:
+                    shutil.copyfile(image, cached)
+            self._publisher.put(image, fmt)
+
+    def get_render_cache(self) -> RenderCache | None:
+        """
+        Return the render cache, or None if there is no cache
+        """
+        if self._render_cache is None and self.render_cache_dir:
+            self._render_cache = RenderCache(
+                self.render_cache_dir, self.render_cache_size
+            )
+        return self._render_cache
+
+    @observe("render_cache_dir", "render_cache_size")
+    def _observe_render_cache(self, change):
+        self._render_cache = None
+
+    def get_data_cache(self) -> BinaryDataCache:
+        """
+        Return the cache of binary copies of data files
+        """
+        if self._data_cache is None:
+            self._data_cache = BinaryDataCache(self.data_cache_dir)
+        return self._data_cache
+
+    @observe("data_cache_dir")
+    def _observe_data_cache_dir(self, change):
+        self._data_cache = None
+
+    def gnuplot_cwd_getter(self, code: str) -> Callable[[], Path | None]:
+        """
+        Return a function that gets the working directory of gnuplot
+
+        Relative data file names are relative to it, not to the
+        directory of the kernel. gnuplot is asked at most once, when
+        the function is first called. The function returns None if
+        the cell may change the directory.
+        """
+
+        @functools.cache
+        def get() -> Path | None:
+            if CHDIR_RE.search(code):
+                return None
+            with contextlib.suppress(GnuplotError):
+                return self.wrapper.working_directory()
+            return None
+
+        return get
+
+    def _save_settings(self) -> str | None:
+        """
+        Return the settings of the session, None if they are unknown
+        """
+        with contextlib.suppress(GnuplotError, OSError):
+            return self.wrapper.save_settings()
+        return None
+
+    def downsample_code(
+        self, code: str, cwd: Callable[[], Path | None] = lambda: None
+    ) -> str:
         """
+        Make the plot statements of a cell plot downsampled data
+
+        The reduction of each line that is downsampled is printed.
+        cwd returns the directory of relative data file names.
+        """
+        try:
+            import numpy  # noqa: F401  # pyright: ignore[reportMissingImports]
+        except ImportError:
+            print(
+                "Warning: Downsampling requires numpy "
+                "(pip install gnuplot_kernel[numpy])."
+            )
+            return code
+
+        if self._downsample_dir is None:
+            self._downsample_dir = Path(
+                tempfile.mkdtemp(prefix="gnuplot-downsample-")
+            )
+
+        m = TERM_WIDTH_RE.search(self.plot_settings["termspec"])
+        width = int(m.group(1)) if m else DEFAULT_TERM_WIDTH
+        downsampler = Downsampler(
+            self._downsample_dir,
+            width,
+            self.downsample_threshold,
+            self.wrapper.datablocks,
+            self._save_settings,
+            cwd,
+        )
+        code = downsampler.rewrite(code)
+        for report in downsampler.reports:
+            print(report)
+        return code
+
+    def render_cache_key(
+        self, code: str, cwd: Callable[[], Path | None]
+    ) -> str | None:
+        """
+        Return the key of a cell in the render cache
+
+        The images of a cell depend on the code, the terminal, the
+        state of the gnuplot session and the data files. Returns
+        None if the cell cannot be cached. cwd returns the working
+        directory of gnuplot, see gnuplot_cwd_getter.
+
+        Getting the state of the session takes a round trip to
+        gnuplot, so keys are only made when there is a render cache.
+        """
+        if not is_plot_only(code) or (directory := cwd()) is None:
+            return None
+
+        # The image counter changes with every cell that plots
+        state = IMG_COUNTER_STATE_RE.sub("", self.wrapper.save_state())
         settings = self.plot_settings
-        if self.inline_plotting:
-            _Image = SVG if settings["format"] == "svg" else Image
+        return cell_key(
+            code,
+            settings["termspec"],
+            settings["format"],
+            state,
+            cwd=directory,
+        )
+
+    def display_cached_images(self, images: list[Path]):
+        """
+        Display images from the render cache
+
+        Parameters
+        ----------
+        images : list[Path]
+            Files of the images, the extension is the format.
+        """
+        for filename in images:
+            fmt = filename.suffix[1:]
+            self.display_image(
+                *self.postprocess_image(filename.read_bytes(), fmt)
+            )
+
+    def display_image(self, data: bytes, fmt: str):
+        """
+        Display an image
+
+        Parameters
+        ----------
+        data : bytes
+            Contents of the image file
+        fmt : str
+            Format of the image
+        """
+        comm = self._image_comm
+        if fmt == "svg":
+            self.Display(SVG(data=data))
+        elif self.image_transport == "comm" and comm:
+            # Send the bytes as they are, and display an element
+            # that the renderer puts them in
+            element_id = f"gnuplot-image-{uuid.uuid4().hex}"
+            self.DisplayData(
+                {
+                    "text/html": f'<img id="{element_id}"/>',
+                    "text/plain": "<gnuplot image>",
+                }
+            )
+            content = {"id": element_id, "mimetype": f"image/{fmt}"}
+            comm.send(content, buffers=[data])
+            self._unacked_images.add(element_id)
         else:
-            return
+            self.Display(Image(data=data, format=fmt))
 
-        for filename in self.iter_image_files():
-            try:
-                size = filename.stat().st_size
-            except FileNotFoundError:
-                size = 0
-
-            if not size:
-                msg = (
-                    "Failed to read and display image file from gnuplot."
-                    "Possibly:\n"
-                    "1. You have plotted to a non interactive terminal.\n"
-                    "2. You have an invalid expression."
+    def postprocess_image(self, data: bytes, fmt: str) -> tuple[bytes, str]:
+        """
+        Make an image smaller before it is displayed
+
+        SVG images that are too heavy for the browser to render are
+        converted to PNG images.
+
+        Parameters
+        ----------
+        data : bytes
+            Contents of the image file
+        fmt : str
+            Format of the image
+
+        Returns
+        -------
+        data : bytes
+            Contents of the image
+        fmt : str
+            Format of the image
+        """
+        if fmt == "svg" and self.is_heavy_svg(data):
+            if (png := rasterize_svg(data)) is not None:
+                data, fmt = png, "png"
+            elif not self._warned_heavy_svg:
+                self._warned_heavy_svg = True
+                print(
+                    "Warning: An SVG image is too large to display "
+                    "quickly. Install cairosvg (pip install "
+                    "gnuplot_kernel[raster]) to display such images as "
+                    "PNG."
                 )
-                print(msg)
-                continue
 
-            im = _Image(str(filename))
-            self.Display(im)
+        if fmt == "png" and self.png_compress_level >= 0:
+            data = recompress_png(data, self.png_compress_level)
+        elif fmt == "svg" and self.svg_precision >= 0:
+            data = minify_svg(data, self.svg_precision)
+        return data, fmt
+
+    def is_heavy_svg(self, data: bytes) -> bool:
+        """
+        Return True if an SVG image is too large to display quickly
+        """
+        return 0 < self.svg_max_size < len(data) or (
+            0 < self.svg_max_elements < svg_element_count(data)
+        )
+
+    def install_image_renderer(self):
+        """
+        Install the renderer of the images sent over the image comm
+
+        It is installed once, it opens the comm when it runs. If the
+        images of an earlier cell have not been acknowledged, the
+        page may have been reloaded without closing the comm. The
+        comm is then dropped, the images are displayed as with
+        'display', and the renderer is installed again.
+        """
+        if (comm := self._image_comm) and self._unacked_images:
+            self._close_image_comm(None)
+            comm.close()
+
+        if not self._renderer_installed:
+            self._renderer_installed = True
+            self.Display(Javascript(IMAGE_RENDERER_JS))
+
+    def _open_image_comm(self, comm, msg):
+        self._image_comm = comm
+        self._unacked_images.clear()
+        comm.on_msg(self._ack_image)
+        comm.on_close(self._close_image_comm)
+
+    def _ack_image(self, msg):
+        self._unacked_images.discard(msg["content"]["data"].get("id"))
+
+    def _close_image_comm(self, msg):
+        self._image_comm = None
+        self._unacked_images.clear()
+        self._renderer_installed = False
+
+    def _display_finished_images(self):
+        """
+        Display the images that gnuplot has finished so far
+        """
+        if self.progressive_display and (self._image_files or self._capture):
+            self.display_images(final=False)
 
     def delete_image_files(self):
         """
         Delete the image files
         """
-        # After display_images(), the real images are
-        # no longer required.
+        # The images of the cell are displayed before the cell
+        # ends, and they are deleted once they are displayed.
+        # These are the rest.
+        self._publisher.join()
+        if self._hidden_images:
+            self.keep_hidden_images()
+
         for filename in self.iter_image_files():
             with contextlib.suppress(FileNotFoundError):
                 filename.unlink()
 
         self._image_files = []
+        self._published = set()
+        self._image_count = 0
+        self._hidden_images = []
+        self._capture = None
+
+    def keep_hidden_images(self):
+        """
+        Report the images left out of a cell and keep them if asked
+        """
+        n = len(self._hidden_images)
+        msg = (
+            f"{n} images were not displayed, the maximum is "
+            f"{self.max_images} per cell."
+        )
+        if self.hidden_image_dir:
+            path = Path(self.hidden_image_dir)
+            path.mkdir(parents=True, exist_ok=True)
+            fmt = self.plot_settings["format"]
+            for image in self._hidden_images:
+                if isinstance(image, bytes):
+                    name = f"gnuplot-inline-{uuid.uuid1()}.{fmt}"
+                    (path / name).write_bytes(image)
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    shutil.move(image, path / image.name)
+            msg = f"{msg} They are in {path}"
+        print(f"[{msg}]")
 
     def makeWrapper(self):
+        """
+        Return wrapper around the REPL of a gnuplot process
+
+        The process comes from the pool, it has most likely been
+        started already.
+        """
+        wrapper = self._pool.get()
+        wrapper.batch = self.batch_execution
+        wrapper.flush_interval = self.stream_flush_interval
+        wrapper.search_window = self.search_window
+        wrapper.read_size = self.read_size
+        wrapper.output_limit = self.output_limit
+        wrapper.interrupt_timeout = self.interrupt_timeout
+        wrapper.idle_handler = self._display_finished_images
+
+        # The process may have been started before the terminal or
+        # the working directory were changed
+        termspec = self.plot_settings.get("termspec") or DEFAULT_TERMSPEC
+        cwd = str(Path.cwd())
+        with contextlib.suppress(GnuplotError):
+            if wrapper.termspec != termspec:
+                wrapper.run_command(f"set terminal {termspec}")
+                wrapper.termspec = termspec
+            if wrapper.cwd != cwd:
+                wrapper.run_command("cd '{}'".format(cwd.replace("'", "''")))
+                wrapper.cwd = cwd
+
+        if checkpoint := self._checkpoint or self.read_checkpoint_file():
+            try:
+                self.restore_checkpoint(checkpoint, wrapper)
+            except GnuplotError as err:
+                print(f"Warning: Failed to restore the checkpoint. {err}")
+        return wrapper
+
+    def start_gnuplot(self):
         """
         Start gnuplot and return wrapper around the REPL
+
+        This runs in a background thread when filling the pool.
         """
         if pexpect.which("gnuplot"):
             program = "gnuplot"
@@ -248,22 +1157,307 @@ class GnuplotKernel(ProcessMetaKernel):
         else:
             command = program
 
+        child = command
+        if self.transport == "pipe":
+            # '-' reads stdin as interactive input, which does not
+            # stop at the first error. stdout, e.g. set print "-",
+            # is line buffered so that it comes before the marker
+            # that gnuplot prints to stderr after the statement.
+            command = f"{command} -"
+            if pexpect.which("stdbuf"):
+                command = f"stdbuf -oL {command}"
+            child = PipeSpawn(command)
+
         wrapper = GnuplotREPLWrapper(
-            cmd_or_spawn=command,
+            cmd_or_spawn=child,
             prompt_regex=PROMPT_RE,
             prompt_change_cmd=None,
         )
         # No sleeping before sending commands to gnuplot
         wrapper.child.delaybeforesend = 0
+
+        # Get the slow loading of the terminal out of the way
+        termspec = self.plot_settings.get("termspec") or DEFAULT_TERMSPEC
+        with contextlib.suppress(GnuplotError):
+            wrapper.run_command(f"set terminal {termspec}")
+            wrapper.termspec = termspec
+        wrapper.cwd = str(Path.cwd())
         return wrapper
 
+    @observe("transport", "pool_size")
+    def _observe_pool(self, change):
+        # The idle processes were started with the old settings
+        if pool := getattr(self, "_pool", None):
+            pool.close()
+            self._pool = WrapperPool(self.start_gnuplot, self.pool_size)
+
+    @observe("batch_execution")
+    def _observe_batch_execution(self, change):
+        if wrapper := getattr(self, "wrapper", None):
+            wrapper.batch = change["new"]
+
+    @observe("stream_flush_interval")
+    def _observe_stream_flush_interval(self, change):
+        if wrapper := getattr(self, "wrapper", None):
+            wrapper.flush_interval = change["new"]
+
+    @observe("search_window")
+    def _observe_search_window(self, change):
+        if wrapper := getattr(self, "wrapper", None):
+            wrapper.search_window = change["new"]
+
+    @observe("read_size")
+    def _observe_read_size(self, change):
+        if wrapper := getattr(self, "wrapper", None):
+            wrapper.read_size = change["new"]
+
+    @observe("interrupt_timeout")
+    def _observe_interrupt_timeout(self, change):
+        if wrapper := getattr(self, "wrapper", None):
+            wrapper.interrupt_timeout = change["new"]
+
+    @observe("output_limit")
+    def _observe_output_limit(self, change):
+        if wrapper := getattr(self, "wrapper", None):
+            wrapper.output_limit = change["new"]
+
+    def respawn_gnuplot(self):
+        """
+        Replace a gnuplot process that has exited
+
+        The new process gets the state of the last checkpoint, and
+        the datablocks of the old process. The terminal and the
+        image counter are set up as they are for a new kernel.
+        """
+        old = self.wrapper
+        with contextlib.suppress(Exception):
+            old.terminate()
+
+        self.wrapper = self.makeWrapper()
+        if datablocks := old.datablocks.values():
+            self.wrapper.load_state("\n".join(datablocks))
+
+        if not self._first:
+            termspec = self.plot_settings["termspec"]
+            self.wrapper.run_command(f"set terminal {termspec}")
+            self.wrapper.run_command(f"{IMG_COUNTER}=0")
+
+        if self._checkpoint:
+            restored = "the last checkpoint"
+        else:
+            restored = "its datablocks and the plot settings"
+        print(f"Warning: gnuplot has been restarted, restored {restored}.")
+
+    def push_array(self, name: str, arr):
+        """
+        Make a NumPy array available to gnuplot as binary data
+
+        The array is written once, as it is in memory, to a file in
+        /dev/shm (if available) and the gnuplot variable name is set
+        to the specification of the data e.g.
+
+            "'/dev/shm/gnuplot-data-xyz.bin' binary record=1000
+             format='%float64%float64' endian=little"
+
+        so that it can be plotted with e.g. ``plot @name using 1:2``.
+        gnuplot reads the numbers without parsing any text.
+
+        Parameters
+        ----------
+        name : str
+            Name of the gnuplot variable
+        arr : numpy.ndarray
+            1D array of one column, or 2D array with a row for each
+            record. The type must be an integer or float type.
+        """
+        import numpy as np  # pyright: ignore[reportMissingImports]
+
+        if not VARIABLE_NAME_RE.match(name):
+            msg = (
+                f"{name!r} is not a valid variable name. Datablocks "
+                "cannot hold binary data, use a name like DATA and "
+                "plot @DATA."
+            )
+            raise ValueError(msg)
+
+        arr = np.asarray(arr)
+        if arr.ndim not in (1, 2):
+            msg = f"Expected a 1D or 2D array, got {arr.ndim}D."
+            raise ValueError(msg)
+
+        key = (arr.dtype.kind, arr.dtype.itemsize)
+        if key not in BINARY_FORMATS:
+            msg = f"Cannot push an array of type {arr.dtype}."
+            raise TypeError(msg)
+
+        # Only an array that is not contiguous is copied
+        arr = np.ascontiguousarray(arr)
+        ncols = 1 if arr.ndim == 1 else arr.shape[1]
+        byteorder = arr.dtype.byteorder
+        if byteorder in "=|":
+            endian = sys.byteorder
+        else:
+            endian = "big" if byteorder == ">" else "little"
+
+        parent = SHM_DIR if os.access(SHM_DIR, os.W_OK) else None
+        fd, filename = tempfile.mkstemp(
+            prefix=f"gnuplot-data-{name}-", suffix=".bin", dir=parent
+        )
+        with os.fdopen(fd, "wb") as f:
+            arr.tofile(f)
+
+        spec = (
+            f"'{filename}' binary record={arr.shape[0]} "
+            f"format='{BINARY_FORMATS[key] * ncols}' endian={endian}"
+        )
+        # Only the variable is set, it is not a cell
+        if not self.wrapper:
+            self.wrapper = self.makeWrapper()
+        self.wrapper.run_command(f'{name} = "{spec}"')
+
+        if old := self._pushed.get(name):
+            old.unlink(missing_ok=True)
+        self._pushed[name] = Path(filename)
+
+    def pull_table(self, code: str) -> list:
+        """
+        Run gnuplot code with set table and return the data as arrays
+
+        The table is written to a FIFO owned by the kernel and read
+        as gnuplot writes it, e.g.
+
+            pull_table("set samples 50; plot [0:1] x**2 smooth csplines")
+
+        returns the points that gnuplot computed in place of drawing
+        them. Contour lines of splot with set contour, samples of
+        functions and the results of smooth can be got this way.
+
+        Parameters
+        ----------
+        code : str
+            gnuplot statements, with the plot, splot or other
+            statements whose data is wanted.
+
+        Returns
+        -------
+        out : list[numpy.ndarray]
+            An array for each block of data, in the order in which
+            gnuplot wrote them. Blocks are separated by blank lines
+            e.g. each plot element, isoline and contour line is a
+            block.
+        """
+        if self._table_fifo is None:
+            fifo = Path(tempfile.mkdtemp(prefix="gnuplot-table-")) / "table"
+            os.mkfifo(fifo)
+            self._table_fifo = fifo
+
+        reader = FifoReader(self._table_fifo)
+        try:
+            result = super().do_execute_direct(
+                f"set table '{self._table_fifo}'\n{code}", silent=True
+            )
+        finally:
+            super().do_execute_direct("unset table", silent=True)
+            data = reader.close()
+
+        if result and (output := result.output.strip()):
+            print(output)
+        return parse_table(data)
+
+    def save_checkpoint(self):
+        """
+        Save the state of the session
+
+        The state is made up of the settings, functions, variables
+        and datablocks of gnuplot, and the reset code and plot
+        settings of the kernel.
+        """
+        self._checkpoint = {
+            "state": self.wrapper.save_state(),
+            "reset_code": self.reset_code,
+            "plot_settings": dict(self.plot_settings),
+        }
+        if self.checkpoint_file:
+            with Path(self.checkpoint_file).open("w") as f:
+                json.dump(self._checkpoint, f)
+
+    def read_checkpoint_file(self) -> dict | None:
+        """
+        Return the checkpoint in the checkpoint file
+
+        Returns None if there is no checkpoint file.
+        """
+        if not self.checkpoint_file:
+            return None
+
+        try:
+            with Path(self.checkpoint_file).open() as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def restore_checkpoint(self, checkpoint=None, wrapper=None):
+        """
+        Restore the session from a checkpoint
+
+        Parameters
+        ----------
+        checkpoint : dict | None
+            Checkpoint as made by save_checkpoint. If None, the last
+            checkpoint.
+        wrapper : GnuplotREPLWrapper | None
+            Wrapper of the gnuplot process to restore. If None, the
+            current one.
+        """
+        checkpoint = checkpoint or self._checkpoint
+        if not checkpoint:
+            raise GnuplotError("There is no checkpoint to restore.")
+
+        wrapper = wrapper or self.wrapper
+        wrapper.load_state(checkpoint["state"])
+        self.reset_code = checkpoint["reset_code"]
+        self.plot_settings.update(checkpoint["plot_settings"])
+        self._checkpoint = checkpoint
+
+    def clear_checkpoint(self):
+        """
+        Forget the last checkpoint and delete the checkpoint file
+        """
+        self._checkpoint = None
+        if self.checkpoint_file:
+            with contextlib.suppress(FileNotFoundError):
+                Path(self.checkpoint_file).unlink()
+
     def do_shutdown(self, restart):
         """
         Exit the gnuplot process and any other underlying stuff
+
+        On a restart, the pool is kept so that the new gnuplot
+        process is one that has already started.
         """
+        if not restart:
+            self._pool.close()
+        self._publisher.close()
+        self.remove_image_dir()
+        self.remove_session_files()
+        if self._downsample_dir:
+            shutil.rmtree(self._downsample_dir, ignore_errors=True)
+            self._downsample_dir = None
+        if self._table_fifo:
+            shutil.rmtree(self._table_fifo.parent, ignore_errors=True)
+            self._table_fifo = None
         self.wrapper.exit()
         super().do_shutdown(restart)
 
+    def remove_session_files(self):
+        """
+        Delete the files of the pushed arrays and the cell outputs
+        """
+        for path in [*self._pushed.values(), *self._output_files]:
+            path.unlink(missing_ok=True)
+        self._pushed = {}
+        self._output_files = []
+
     def get_kernel_help_on(self, info, level=0, none_on_fail=False):
         obj = info.get("help_obj", "")
         if not obj or len(obj.split()) > 1:
@@ -289,7 +1483,7 @@ class GnuplotKernel(ProcessMetaKernel):
         """
         settings = self.plot_settings
         if "termspec" not in settings or not settings["termspec"]:
-            settings["termspec"] = 'pngcairo size 385, 256 font "Arial,10"'
+            settings["termspec"] = DEFAULT_TERMSPEC
         if "format" not in settings or not settings["format"]:
             settings["format"] = "png"
 
@@ -0,0 +1,34 @@
+from metakernel import Magic
+
+
+class CheckpointMagic(Magic):
+    def line_checkpoint(self, action="save"):
+        """
+        %checkpoint [save|restore|clear] - Manage session checkpoints
+
+        A checkpoint holds the settings, functions, variables and
+        datablocks of the gnuplot session. When gnuplot is
+        restarted, the session is restored from the last checkpoint.
+
+        Examples:
+            %checkpoint
+            %checkpoint restore
+            %checkpoint clear
+        """
+        action = action.strip() or "save"
+        if action == "save":
+            self.kernel.save_checkpoint()
+        elif action == "restore":
+            self.kernel.restore_checkpoint()
+        elif action == "clear":
+            self.kernel.clear_checkpoint()
+        else:
+            msg = "Use one of: %checkpoint [save|restore|clear]"
+            raise ValueError(msg)
+
+
+def register_magics(kernel):
+    """
+    Make the checkpoint magic available for the GnuplotKernel
+    """
+    kernel.register_magics(CheckpointMagic)
@@ -0,0 +1,46 @@
+from metakernel import Magic
+
+USAGE = "Use one of: %downsample [on|off]"
+
+
+class DownsampleMagic(Magic):
+    def line_downsample(self, action="on"):
+        """
+        %downsample [on|off] - Downsample oversized line plots
+
+        Turns downsampling on or off for the cells that follow. The
+        lines of plots with many more points than the plot has
+        pixel columns are drawn from the first, last, lowest and
+        highest point of each pixel column.
+
+        Examples:
+            %downsample
+            %downsample off
+        """
+        self.kernel.downsample = _parse_action(action)
+
+    def cell_downsample(self, action="on"):
+        """
+        %%downsample [on|off] - Downsample oversized line plots of a cell
+
+        Turns downsampling on or off for this cell only.
+
+        Examples:
+            %%downsample
+            plot 'big.dat' using 1:2 with lines
+        """
+        self.kernel._downsample_cell = _parse_action(action)
+
+
+def _parse_action(action: str) -> bool:
+    action = action.strip() or "on"
+    if action not in ("on", "off"):
+        raise ValueError(USAGE)
+    return action == "on"
+
+
+def register_magics(kernel):
+    """
+    Make the downsample magic available for the GnuplotKernel
+    """
+    kernel.register_magics(DownsampleMagic)
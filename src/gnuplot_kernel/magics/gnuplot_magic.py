@@ -1,4 +1,8 @@
-from IPython.core.magic import register_cell_magic, register_line_magic
+from IPython.core.magic import (
+    register_cell_magic,
+    register_line_cell_magic,
+    register_line_magic,
+)
 from metakernel import Magic
 
 
@@ -39,8 +43,12 @@ class GnuplotMagic(Magic):
             %gnuplot inline pngcairo enhanced transparent size 560,420
             %gnuplot inline svg enhanced size 560,420 fixed
             %gnuplot inline jpeg enhanced nointerlace
+            %gnuplot inline gif animate delay 10 size 560,420
             %gnuplot qt
 
+        With 'gif animate', all the plots of a cell are the frames
+        of one animated image.
+
         """
         backend, terminal, termspec = _parse_args(args)
         terminal = terminal or "pngcairo"
@@ -49,13 +57,14 @@ class GnuplotMagic(Magic):
             "png": "png",
             "jpeg": "jpg",
             "svg": "svg",
+            "gif": "gif",
         }
         format = inline_terminals.get(terminal, "png")
 
         if backend == "inline" and terminal not in inline_terminals:
             msg = (
                 "For inline plots, the terminal must be "
-                "one of pngcairo, jpeg, svg or png"
+                "one of pngcairo, jpeg, svg, png or gif"
             )
             raise ValueError(msg)
 
@@ -126,6 +135,51 @@ def register_ipython_magics():
         magic.code = cell
         magic.cell_gnuplot()
 
+    @register_line_magic
+    def gnuplot_push(line):
+        """
+        %gnuplot_push ARRAY as NAME - push a NumPy array into gnuplot
+
+        The array is written as binary data, and the gnuplot
+        variable NAME is set so that the data can be plotted with
+        '@NAME' in place of a filename.
+
+        Example:
+            %gnuplot_push np.column_stack([x, y]) as DATA
+
+            %%gnuplot
+            plot @DATA using 1:2 with lines
+        """
+        expr, sep, name = line.rpartition(" as ")
+        if not sep:
+            msg = "Usage: %gnuplot_push ARRAY as NAME"
+            raise ValueError(msg)
+        kernel.push_array(name.strip(), ip.ev(expr))  # pyright: ignore[reportOptionalMemberAccess]
+
+    @register_line_cell_magic
+    def gnuplot_pull(line, cell=None):
+        """
+        %gnuplot_pull NAME CODE - get data computed by gnuplot
+
+        Runs the gnuplot CODE with 'set table' and sets the Python
+        variable NAME to a list of NumPy arrays, one for each block
+        of data in the table. As a cell magic, the cell is the code.
+
+        Examples:
+            %gnuplot_pull curves plot [0:1] x**2, 'data.txt' smooth bezier
+
+            %%gnuplot_pull contours
+            set contour base; unset surface
+            splot x**2 - y**2
+        """
+        name, _, code = line.strip().partition(" ")
+        if cell is not None:
+            code = cell
+        if not name.isidentifier() or not code.strip():
+            msg = "Usage: %gnuplot_pull NAME CODE"
+            raise ValueError(msg)
+        ip.user_ns[name] = kernel.pull_table(code)  # pyright: ignore[reportOptionalMemberAccess]
+
 
 def _parse_args(args):
     """
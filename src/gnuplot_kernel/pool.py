@@ -0,0 +1,111 @@
+import contextlib
+import queue
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from .replwrap import GnuplotREPLWrapper
+
+
+class WrapperPool:
+    """
+    Gnuplot processes that are started ahead of time
+
+    The processes are started in background threads, so when one
+    is needed it has (most likely) already started and can be used
+    right away. Each time one is taken, another is started to take
+    its place. Nothing is started until the first process is taken.
+
+    Parameters
+    ----------
+    factory : callable
+        Starts gnuplot and returns a wrapper around it.
+    size : int
+        Number of idle processes to keep ready. If 0, a process is
+        only started when it is needed.
+    """
+
+    def __init__(self, factory: "Callable[[], GnuplotREPLWrapper]", size=1):
+        self.factory = factory
+        self.size = size
+        # Holds the wrappers and the errors from starting them
+        self._ready: queue.Queue = queue.Queue()
+        self._starting = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def fill(self):
+        """
+        Start processes in the background until the pool is full
+        """
+        with self._lock:
+            n = self.size - self._ready.qsize() - self._starting
+            self._starting += max(n, 0)
+
+        for _ in range(n):
+            threading.Thread(target=self._start, daemon=True).start()
+
+    def _start(self):
+        """
+        Start a process and add it to the pool
+        """
+        try:
+            item = self.factory()
+        except Exception as err:
+            item = err
+
+        with self._lock:
+            self._starting -= 1
+            if not self._closed:
+                self._ready.put(item)
+                return
+
+        _terminate(item)
+
+    def get(self) -> "GnuplotREPLWrapper":
+        """
+        Take a wrapper out of the pool
+
+        If the pool is empty, wait for a process that is starting.
+        The errors that stop gnuplot from starting are raised here.
+        """
+        if not self.size:
+            return self.factory()
+
+        while True:
+            self.fill()
+            item = self._ready.get()
+            self.fill()
+            if isinstance(item, Exception):
+                raise item
+            if item.child.isalive():
+                return item
+
+    def close(self):
+        """
+        Stop the idle processes
+
+        Processes that are still starting are stopped once they
+        have started.
+        """
+        with self._lock:
+            self._closed = True
+            self.size = 0
+
+        while True:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            _terminate(item)
+
+
+def _terminate(item):
+    """
+    Stop the process of a wrapper in the pool
+    """
+    if not isinstance(item, Exception):
+        with contextlib.suppress(Exception):
+            item.terminate()
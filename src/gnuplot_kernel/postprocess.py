@@ -0,0 +1,131 @@
+"""
+Make inline images smaller before they are displayed
+
+The transformations are lossless to the eye, they only change how
+the image is stored. Except for rasterize_svg, which makes images
+that are too heavy for the browser lighter.
+"""
+
+import re
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Attributes of SVG elements that hold coordinates
+SVG_COORD_ATTR_RE = re.compile(
+    rb"(?<=\s)(d|points|transform|x|y|x1|y1|x2|y2|cx|cy|r|rx|ry"
+    rb'|width|height)="([^"]*)"'
+)
+SVG_NUMBER_RE = re.compile(rb"-?\d+\.\d+")
+# Indentation and line breaks between the tags, gnuplot puts each
+# element on a line. Whitespace within a line may be part of a text.
+SVG_INDENT_RE = re.compile(rb">[ \t]*\r?\n\s*<")
+
+
+def recompress_png(data: bytes, level: int = 9) -> bytes:
+    """
+    Compress the pixels of a PNG image again
+
+    The image data (IDAT chunks) is compressed at the given zlib
+    level into a single chunk, the other chunks are unchanged.
+
+    Parameters
+    ----------
+    data : bytes
+        PNG image
+    level : int
+        zlib compression level, 0-9.
+
+    Returns
+    -------
+    out : bytes
+        PNG image. If it is not smaller, it is the input.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    chunks: list[bytes | None] = []
+    idat = []
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos : pos + 4])
+        ctype = data[pos + 4 : pos + 8]
+        end = pos + 12 + length
+        if ctype == b"IDAT":
+            if not idat:
+                # Where the image data goes
+                chunks.append(None)
+            idat.append(data[pos + 8 : end - 4])
+        else:
+            chunks.append(data[pos:end])
+        pos = end
+
+    compressed = zlib.compress(zlib.decompress(b"".join(idat)), level)
+    if len(compressed) >= sum(len(b) for b in idat):
+        return data
+
+    image_data = _png_chunk(b"IDAT", compressed)
+    return PNG_SIGNATURE + b"".join(
+        image_data if c is None else c for c in chunks
+    )
+
+
+def _png_chunk(ctype: bytes, body: bytes) -> bytes:
+    """
+    Create a PNG chunk
+    """
+    crc = zlib.crc32(ctype + body)
+    return struct.pack(">I", len(body)) + ctype + body + struct.pack(">I", crc)
+
+
+def minify_svg(data: bytes, precision: int = 1) -> bytes:
+    """
+    Make an SVG image smaller
+
+    The coordinates are rounded to the given number of decimal
+    places and the indentation between the elements is removed.
+    Texts are not changed.
+
+    Parameters
+    ----------
+    data : bytes
+        SVG image
+    precision : int
+        Number of decimal places of the coordinates.
+    """
+
+    def round_number(m: re.Match) -> bytes:
+        s = f"{float(m.group()):.{precision}f}"
+        if "." in s:
+            s = s.rstrip("0").rstrip(".")
+        return b"0" if s == "-0" else s.encode()
+
+    def round_attr(m: re.Match) -> bytes:
+        value = SVG_NUMBER_RE.sub(round_number, m.group(2))
+        return m.group(1) + b'="' + value + b'"'
+
+    data = SVG_COORD_ATTR_RE.sub(round_attr, data)
+    return SVG_INDENT_RE.sub(b"><", data)
+
+
+def svg_element_count(data: bytes) -> int:
+    """
+    Return the number of elements in an SVG image
+    """
+    return data.count(b"<") - data.count(b"</") - data.count(b"<!")
+
+
+def rasterize_svg(data: bytes) -> bytes | None:
+    """
+    Convert an SVG image to a PNG image of the same size
+
+    Returns None if cairosvg, which does the conversion, is not
+    installed.
+    """
+    try:
+        import cairosvg  # pyright: ignore[reportMissingImports]
+    except ImportError:
+        return None
+
+    return cairosvg.svg2png(bytestring=data)
@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+READ_FAILED_MSG = (
+    "Failed to read and display image file from gnuplot."
+    "Possibly:\n"
+    "1. You have plotted to a non interactive terminal.\n"
+    "2. You have an invalid expression."
+)
+
+
+class ImagePublisher:
+    """
+    Display image files from a background thread
+
+    Reading an image file, encoding the image and sending it to
+    the frontend are done by a worker thread, so the kernel can go
+    on sending statements to gnuplot in the meantime. The images
+    are displayed in the order in which they are put.
+
+    The images are read and processed by a pool of threads, many
+    at a time, ahead of the worker that displays them.
+
+    Parameters
+    ----------
+    display : callable
+        Displays an image, it is called with the bytes and the
+        format of the image.
+    process : callable | None
+        Transforms an image before it is displayed, it is called
+        with the bytes and the format of the image and returns
+        the new bytes and format.
+    maxsize : int
+        Maximum number of images waiting to be displayed. When
+        the queue is full, put() waits for the worker.
+    """
+
+    def __init__(
+        self,
+        display: "Callable",
+        process: "Callable | None" = None,
+        maxsize=8,
+    ):
+        self.display = display
+        self.process = process
+        self._queue: queue.Queue = queue.Queue(maxsize)
+        self._executor: ThreadPoolExecutor | None = None
+
+    def put(self, image: "Path | bytes", fmt: str):
+        """
+        Queue an image, or an image file, to be displayed
+
+        A file is deleted once it has been read.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(min(4, os.cpu_count() or 1))
+            threading.Thread(target=self._run, daemon=True).start()
+        future = self._executor.submit(self._load, image, fmt)
+        self._queue.put(future)
+
+    def join(self):
+        """
+        Wait until all the queued images have been displayed
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Stop the worker once it has displayed the queued images
+        """
+        if self._executor is not None:
+            self._queue.put(None)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                data, fmt = item.result()
+                if data:
+                    self.display(data, fmt)
+                else:
+                    print(READ_FAILED_MSG)
+            except Exception as err:
+                print(f"Error: {err}")
+            finally:
+                self._queue.task_done()
+
+    def _load(self, image: "Path | bytes", fmt: str) -> tuple[bytes, str]:
+        """
+        Read an image file, delete it and process the image
+        """
+        if isinstance(image, bytes):
+            data = image
+        else:
+            try:
+                data = image.read_bytes()
+            except FileNotFoundError:
+                return b"", fmt
+            image.unlink()
+
+        if data and self.process:
+            data, fmt = self.process(data, fmt)
+        return data, fmt
@@ -1,12 +1,24 @@
+import contextlib
+import os
 import re
+import selectors
 import signal
+import tempfile
 import textwrap
-from typing import cast
+import time
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, cast
 
 from metakernel import REPLWrapper
-from metakernel.pexpect import TIMEOUT
+from metakernel.pexpect import EOF, TIMEOUT
 
-from .exceptions import GnuplotError
+from .exceptions import GnuplotError, GnuplotExited
+from .spawn import PipeSpawn
+from .statement import STMT
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
 
 CRLF = "\r\n"
 NO_BLOCK = ""
@@ -17,15 +29,58 @@ ERROR_RE = [
         r"\^"  # Indicates error on above line
         r"\s*"
         r"\n"
-    )
+    ),
+    # Without a terminal, gnuplot first repeats the offending line
+    re.compile(
+        r"^\s*"
+        r"\w*>[^\n]*\n"  # gnuplot> offending line
+        r"\s*"
+        r"\^"
+        r"\s*"
+        r"\n"
+    ),
 ]
 
+# Without a terminal, error messages start with a line number
+# e.g. "line 0: undefined variable: x"
+ERROR_LOCATION_RE = re.compile(r"^(\s*)line \d+: ", re.MULTILINE)
+
+# The prompts only match at the start of a word. It is the same
+# match, but a long output is not searched again from every
+# character in every word.
 PROMPT_RE = re.compile(
     # most likely "gnuplot> "
-    r"\w*>\s*$"
+    r"(?<!\w)\w*>\s*$"
+)
+
+PROMPT_REMOVE_RE = re.compile(r"(?<!\w)\w*>\s*")
+
+# The prompts that gnuplot prints when it reads a pipe as
+# interactive input
+PIPE_PROMPT_RE = re.compile(r"(?m)^(?:(?:gnuplot|more)> )+")
+
+# The prompt in front of a statement that gnuplot repeats
+ECHO_PREFIX_RE = re.compile(r"^\w*>\s*")
+
+# Gnuplot asks for a subtopic after help on topics that have them
+HELP_PROMPT_RE = re.compile(
+    r"(?:Help topic|Subtopic of [^\n]*|Press return for more): $"
 )
 
-PROMPT_REMOVE_RE = re.compile(r"\w*>\s*")
+# An interrupted fit asks what to do next
+FIT_INTERRUPT_RE = re.compile(r"\(S\)top fit, \(C\)ontinue, [^\n]*: *$")
+
+# End of a line of output
+NEWLINE_RE = re.compile(r"\r?\n")
+
+# Shortest time to wait for output when streaming it
+MIN_WAIT = 0.01
+
+# How often (seconds) to check that gnuplot is still running while
+# it is quiet. A process that dies normally closes the terminal and
+# is noticed at once, this catches one whose terminal stays open.
+# The idle_handler is called as often.
+CHILD_CHECK_INTERVAL = 0.1
 
 # Data block e.g.
 # $DATA << EOD
@@ -34,28 +89,77 @@ PROMPT_REMOVE_RE = re.compile(r"\w*>\s*")
 # 2 2
 # 3 3
 # EOD
+# The block ends at the line that is the end string
 START_DATABLOCK_RE = re.compile(
     # $DATA << EOD
-    r"^\$\w+\s+<<\s*(?P<end>\w+)$"
-)
-END_DATABLOCK_RE = re.compile(
-    # EOD
-    r"^(?P<end>\w+)$"
+    r"^(?P<name>\$\w+)\s+<<\s*(?P<end>\w+)$"
 )
 
 
+# Inline data ('-') is terminated by this line
+END_INLINE_DATA = "e"
+
+
 class GnuplotREPLWrapper(REPLWrapper):
     # The prompt after the commands run
     prompt = ""
-    _blocks = {
-        "data": {"start_re": START_DATABLOCK_RE, "end_re": END_DATABLOCK_RE}
-    }
-    _current_block = NO_BLOCK
+    # Whether to send whole cells to gnuplot in one round trip
+    batch = False
+    # Maximum time (seconds) that streamed output is held back
+    flush_interval = 0.1
+    # Number of characters at the end of the output that are searched
+    # again for a match once more output arrives
+    search_window = 4096
+    # Maximum number of characters read from gnuplot at a time
+    read_size = 65536
+    # Maximum number of characters of output kept in memory
+    output_limit = 10_000_000
+    # File with all the output of the last command, if the output
+    # was longer than output_limit
+    output_path: Path | None = None
+    # Maximum time (seconds) gnuplot has to stop after an interrupt
+    interrupt_timeout = 5.0
+    # Whether the last command was interrupted
+    interrupted = False
+    # The error of the last command, if it failed
+    error: GnuplotError | None = None
+    # The terminal and the working directory that gnuplot was
+    # started with
+    termspec = ""
+    cwd = ""
+    # Called while waiting on gnuplot when it is quiet
+    idle_handler: "Callable[[], None] | None" = None
+    _blocks = {"data": {"start_re": START_DATABLOCK_RE}}
+    # Marks the end of the output of a statement on the pipe transport
+    _marker = ""
+
+    def __init__(self, cmd_or_spawn, prompt_regex, prompt_change_cmd, **kw):
+        if isinstance(cmd_or_spawn, PipeSpawn):
+            # gnuplot does not prompt when it is not reading from a
+            # terminal. After every statement, we have it print a
+            # marker and the marker takes the place of the prompt.
+            self._marker = f"gpk{uuid.uuid4().hex}"
+            prompt_regex = re.compile(rf"(?:gnuplot> )*{self._marker}\n")
+            cmd_or_spawn.send(f'printerr "{self._marker}"\n')
+        # The datablocks that have been defined, by name
+        self.datablocks: dict[str, str] = {}
+        super().__init__(cmd_or_spawn, prompt_regex, prompt_change_cmd, **kw)
+
+    @property
+    def piped(self):
+        """
+        Whether gnuplot is driven over pipes instead of a terminal
+        """
+        return bool(self._marker)
 
     def exit(self):
         """
         Exit the gnuplot process
         """
+        if self.piped:
+            # gnuplot exits at the end of its input
+            return self.child.sendeof()
+
         try:
             self._force_prompt(timeout=0.01)
         except GnuplotError:
@@ -63,6 +167,42 @@ class GnuplotREPLWrapper(REPLWrapper):
 
         self.sendline("exit")
 
+    def interrupt(self, continuation=False):
+        """
+        Stop the running statement and wait for gnuplot to be ready
+
+        If gnuplot has not stopped within interrupt_timeout seconds,
+        it is killed.
+
+        Returns the output up to the prompt.
+        """
+        self.interrupted = True
+        self.child.sendintr()
+
+        expects = [self.prompt_regex, FIT_INTERRUPT_RE, HELP_PROMPT_RE]
+        deadline = time.monotonic() + self.interrupt_timeout
+        output_lines = []
+        while True:
+            timeout = max(deadline - time.monotonic(), 0)
+            try:
+                pos = self._expect(expects, timeout=timeout)
+            except TIMEOUT:
+                self.child.kill(signal.SIGKILL)
+                break
+            except GnuplotExited:
+                break
+            finally:
+                output_lines.append(cast("str", self.child.before))
+
+            if pos == 0:
+                self.prompt = self.child.after
+                break
+
+            # Stop the fit, or leave the help
+            self._reply("s" if pos == 1 else "")
+
+        return "".join(output_lines).replace(CRLF, "\n")
+
     def is_error_output(self, text):
         """
         Return True if text is recognised as error text
@@ -83,66 +223,164 @@ class GnuplotREPLWrapper(REPLWrapper):
         return code
 
     def send(self, cmd):
-        self.child.send(cmd + "\r")
+        if self.piped:
+            self.child.send(f'{cmd}\nprinterr "{self._marker}"\n')
+        else:
+            self.child.send(cmd + "\r")
 
-    def _force_prompt(self, timeout: float = 30, n=4):
+    def _reply(self, text=""):
         """
-        Force prompt
+        Answer a question from gnuplot e.g. a help subtopic
         """
-        quick_timeout = 0.05
+        self.child.send(text + ("\n" if self.piped else "\r"))
 
-        if timeout < quick_timeout:
-            quick_timeout = timeout
+    def _expect_prompt(self, timeout=None):
+        """
+        Wait for the prompt
 
-        def quick_prompt():
-            try:
-                self._expect_prompt(timeout=quick_timeout)
-                return True
-            except TIMEOUT:
-                return False
+        This overrides the baseclass method so that all waiting
+        is done by _expect.
+        """
+        return self._expect([self.prompt_regex], timeout=timeout)
 
-        def patient_prompt():
-            try:
-                self._expect_prompt(timeout=timeout)
-                return True
-            except TIMEOUT:
-                return False
+    def _expect(
+        self,
+        patterns,
+        timeout: float | None = 30,
+        sink: "Callable[[str], None] | None" = None,
+    ):
+        """
+        Read gnuplot output until it matches one of the patterns
 
-        # Eagerly try to get a prompt quickly,
-        # If that fails wait a while
-        for _ in range(n):
-            if quick_prompt():
-                break
+        The reader sleeps until the gnuplot process writes to the
+        terminal, and each time it does, the output is checked
+        for the patterns. No time is lost between the output
+        and the match.
 
-            # Probably stuck in help output
-            if self.child.before:
-                self.send(self.child.linesep)
-        else:
-            # Probably long computation going on
-            if not patient_prompt():
-                msg = (
-                    "gnuplot prompt failed to return in in {} seconds"
-                ).format(timeout)
-                raise GnuplotError(msg)
+        Only the new output and the last search_window characters
+        before it are searched, anything earlier has already been
+        searched and is set aside. So however long the output gets,
+        the cost of a read stays proportional to the size of the
+        read.
 
-    def _end_of_block(self, stmt, end_string):
-        """
-        Detect the end of block statements
+        While gnuplot is quiet, the idle_handler is called every
+        CHILD_CHECK_INTERVAL seconds.
 
         Parameters
         ----------
-        stmt : str
-            Statement to be executed by gnuplot repl
+        patterns : list[str | re.Pattern]
+            Regular expressions to look for in the output. If more
+            than one matches, the one that matches earliest wins.
+        timeout : float | None
+            Maximum time to wait for a match. If None, wait forever.
+            If -1, use the timeout of the child process.
+        sink : callable | None
+            If given, whole lines of output that have been set aside
+            are passed to it instead of being kept for child.before.
 
         Returns
         -------
-        end_string : str
-            Terminal string for the current block.
+        out : int
+            Index of the pattern that matched. As with pexpect, the
+            output before the match is in child.before and the
+            matched text is in child.after. Output after the match
+            remains in the buffer of the child.
+
+        Raises
+        ------
+        GnuplotExited
+            If the gnuplot process exits before a match.
         """
-        pattern = self._blocks[self._current_block]["end_re"]
-        if m := pattern.match(stmt):
-            return m.group("end") == end_string
-        return False
+        child = self.child
+        patterns = [
+            re.compile(p) if isinstance(p, str) else p for p in patterns
+        ]
+        if timeout == -1:
+            timeout = child.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        # Output that has been searched and can no longer be part of
+        # a match, and the output that is still searched
+        searched = []
+        keep = searched.append if sink is None else sink
+        data = cast("str", child.buffer)
+        child.buffer = ""
+        with selectors.DefaultSelector() as selector:
+            selector.register(child.child_fd, selectors.EVENT_READ)
+            while True:
+                if match := _earliest_match(patterns, data):
+                    pos, m = match
+                    searched.append(data[: m.start()])
+                    child.before = "".join(searched)
+                    child.after = m.group()
+                    child.buffer = data[m.end() :]
+                    return pos
+
+                # Set aside whole lines, so that a line ending is
+                # never split
+                if (n := len(data) - self.search_window) > 0:
+                    n = data.rfind("\n", 0, n) + 1 or n
+                    keep(data[:n])
+                    data = data[n:]
+
+                wait = CHILD_CHECK_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        child.before = "".join(searched) + data
+                        raise TIMEOUT(f"Timeout exceeded after {timeout}s")
+                    wait = min(remaining, wait)
+
+                if not selector.select(wait):
+                    if not child.isalive():
+                        child.before = "".join(searched) + data
+                        raise _exited(child)
+                    if self.idle_handler:
+                        self.idle_handler()
+                    continue
+
+                try:
+                    data += child.read_nonblocking(self.read_size, timeout=0)
+                except TIMEOUT:
+                    continue
+                except EOF as err:
+                    child.before = "".join(searched) + data
+                    raise _exited(child) from err
+
+    def _force_prompt(
+        self,
+        timeout: float = 30,
+        sink: "Callable[[str], None] | None" = None,
+    ):
+        """
+        Wait for the prompt
+
+        Help on a topic with subtopics asks for a subtopic, that
+        request is declined so that the prompt can return.
+
+        If a sink is given, most of the output may be passed to it
+        instead of ending up in child.before. See _expect.
+        """
+        expects = [self.prompt_regex, HELP_PROMPT_RE]
+        output_lines = []
+        while True:
+            try:
+                pos = self._expect(expects, timeout=timeout, sink=sink)
+            except TIMEOUT as err:
+                raise _prompt_timeout(timeout) from err
+
+            output_lines.append(cast("str", self.child.before))
+            if pos == 0:
+                break
+
+            output_lines.append(cast("str", self.child.after))
+            # Keep the output in order
+            if sink:
+                sink("".join(output_lines))
+                output_lines = []
+            self._reply()
+
+        self.child.before = "".join(output_lines)
 
     def _start_of_block(self, stmt):
         """
@@ -179,37 +417,454 @@ class GnuplotREPLWrapper(REPLWrapper):
         # confuses the repl processing. We detect a block and concatenate
         # it into single line so that after executing the line we can
         # get a prompt.
+        # The lines in a block are not looked at one by one, the end
+        # of the block is found with a single search.
         lines = []
-        block_lines = []
-        end_string = ""
         stmts = code.splitlines()
-        for stmt in stmts:
-            if self._current_block:
-                block_lines.append(stmt)
-                if self._end_of_block(stmt, end_string):
-                    self._current_block = NO_BLOCK
-                    block_lines.append("")
-                    block = "\n".join(block_lines)
-                    lines.append(block)
-                    block_lines = []
-                    end_string = ""
-            else:
-                block_name, end_string = self._start_of_block(stmt)
-                if block_name:
-                    self._current_block = block_name
-                    block_lines.append(stmt)
-                else:
-                    lines.append(stmt)
+        i = 0
+        while i < len(stmts):
+            stmt = stmts[i]
+            block_name, end_string = self._start_of_block(stmt)
+            if not block_name:
+                lines.append(stmt)
+                i += 1
+                continue
 
-        if self._current_block:
-            msg = "Error: {} block not terminated correctly.".format(
-                self._current_block
-            )
-            self._current_block = NO_BLOCK
-            raise GnuplotError(msg)
+            try:
+                end = stmts.index(end_string, i + 1)
+            except ValueError:
+                msg = f"Error: {block_name} block not terminated correctly."
+                raise GnuplotError(msg) from None
+
+            block = "\n".join(stmts[i : end + 1]) + "\n"
+            lines.append(block)
+            if m := START_DATABLOCK_RE.match(stmt):
+                self.datablocks[m.group("name")] = block
+            i = end + 1
 
         return lines
 
+    def save_state(self):
+        """
+        Return the state of the gnuplot session
+
+        Returns
+        -------
+        out : str
+            gnuplot script that recreates the settings, functions,
+            variables and datablocks of the session. The terminal
+            and output are not part of it.
+        """
+        parts = ("set", "functions", "variables")
+        with tempfile.TemporaryDirectory(prefix="gnuplot-state-") as tmp:
+            paths = [Path(tmp) / f"{what}.gp" for what in parts]
+            # One statement, one round trip
+            self.run_command(
+                "; ".join(
+                    f"save {what} '{path}'"
+                    for what, path in zip(parts, paths, strict=True)
+                )
+            )
+            texts = [path.read_text() for path in paths]
+
+        texts.extend(self.datablocks.values())
+        return "\n".join(texts)
+
+    def save_settings(self) -> str:
+        """
+        Return the settings of the gnuplot session
+
+        Returns
+        -------
+        out : str
+            Settings as written by save set.
+        """
+        with tempfile.TemporaryDirectory(prefix="gnuplot-state-") as tmp:
+            path = Path(tmp) / "set.gp"
+            self.run_command(f"save set '{path}'")
+            return path.read_text()
+
+    def load_state(self, state):
+        """
+        Restore the state of a gnuplot session
+
+        Parameters
+        ----------
+        state : str
+            State as returned by save_state.
+        """
+        fd, name = tempfile.mkstemp(prefix="gnuplot-state-", suffix=".gp")
+        path = Path(name)
+        with os.fdopen(fd, "w") as f:
+            f.write(state)
+
+        try:
+            self.run_command(f"load '{path}'")
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+
+        # Splitting the lines records the datablocks
+        self._splitlines(state)
+
+    def working_directory(self) -> Path:
+        """
+        Return the working directory of gnuplot
+        """
+        # pwd prints to stderr, whatever the print destination is
+        lines = self.run_command("pwd").strip().splitlines()
+        if not lines:
+            raise GnuplotError("pwd printed nothing.")
+        return Path(lines[-1])
+
+    def _group_statements(self, stmts):
+        """
+        Join the lines that gnuplot reads as part of one statement
+
+        Parameters
+        ----------
+        stmts : list[str]
+            Lines as returned by _splitlines.
+
+        Returns
+        -------
+        out : list[str]
+            Top level statements. These include whole bracketed
+            blocks (e.g. do for [...] {...}) and plot statements
+            together with their inline data.
+        """
+        groups = []
+        lines = []
+        depth = 0
+        n_inline_data = 0
+        for line in stmts:
+            lines.append(line)
+            if n_inline_data:
+                if line.strip() == END_INLINE_DATA:
+                    n_inline_data -= 1
+            # Datablocks are already whole
+            elif "\n" not in line:
+                stmt = STMT(line)
+                depth += stmt.brace_balance()
+                n_inline_data = stmt.count_inline_data()
+
+            if depth <= 0 and not n_inline_data:
+                groups.append("\n".join(lines))
+                lines = []
+                depth = 0
+
+        if lines:
+            groups.append("\n".join(lines))
+        return groups
+
+    @contextlib.contextmanager
+    def _datablock_files(self, stmts):
+        """
+        Replace the datablocks with statements that load them
+
+        Each datablock is written to a file, and gnuplot reads it
+        from there in one go. The files are deleted on exit.
+
+        Parameters
+        ----------
+        stmts : list[str]
+            Lines as returned by _splitlines. The datablocks are
+            the lines with more than one line in them.
+
+        Yields
+        ------
+        out : list[str]
+            The lines with the datablocks replaced.
+        """
+        paths = []
+        lines = []
+        try:
+            for stmt in stmts:
+                if "\n" in stmt:
+                    fd, name = tempfile.mkstemp(
+                        prefix="gnuplot-datablock-", suffix=".gp"
+                    )
+                    with os.fdopen(fd, "w") as f:
+                        f.write(stmt)
+                    paths.append(Path(name))
+                    stmt = f"load '{name}'"
+                lines.append(stmt)
+            yield lines
+        finally:
+            for path in paths:
+                path.unlink(missing_ok=True)
+
+    def _can_batch(self, stmts):
+        """
+        Return True if the statements can be run as a batch
+
+        Statements that wait on the user or end the session must
+        be run one at a time, including those in loops and after
+        a ';' on the same line.
+        """
+        return not any(
+            sub.is_interactive() or sub.is_exit()
+            for stmt in stmts
+            for sub in STMT(stmt).substatements()
+        )
+
+    def _run_batch(self, stmts, stream=None, output=None, timeout: float = 30):
+        """
+        Run statements in one round trip to gnuplot
+
+        The statements are written to a script with a sentinel
+        after each of them, and gnuplot is asked to load the script.
+        The output is split at the sentinels, so the statement that
+        fails is known. Like the statement by statement execution,
+        an error stops the rest of the statements, that is how
+        gnuplot handles errors in loaded files.
+
+        Parameters
+        ----------
+        stmts : list[str]
+            Lines as returned by _splitlines.
+        stream : OutputStream | None
+            If given, the output is passed on to it as it arrives.
+        output : OutputBuffer | None
+            If there is no stream, where the output is collected.
+        timeout : float
+            Maximum time to wait on any single statement.
+        """
+        stmts = self._group_statements(stmts)
+        token = f"gpk{uuid.uuid4().hex}"
+        sentinel_re = re.compile(rf"{token}:(\d+)\r?\n")
+        script_lines = []
+        for i, stmt in enumerate(stmts):
+            script_lines.append(stmt)
+            script_lines.append(f'printerr "{token}:{i}"')
+
+        fd, name = tempfile.mkstemp(prefix="gnuplot-batch-", suffix=".gp")
+        script = Path(name)
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(script_lines))
+            f.write("\n")
+
+        # Errors in the script are reported as '"script" line n: msg'
+        location_re = re.compile(rf'"{re.escape(str(script))}",? line \d+: ')
+        cmd = f"load '{script}'"
+        try:
+            self.send(cmd)
+            if stream:
+                self._stream(
+                    stmts, stream, [cmd], sentinel_re, location_re, timeout
+                )
+            else:
+                self._read_batch(
+                    stmts, cmd, sentinel_re, location_re, output, timeout
+                )
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                script.unlink()
+
+    def _read_batch(
+        self, stmts, cmd, sentinel_re, location_re, output, timeout
+    ):
+        """
+        Read the output of a batch, one statement at a time
+        """
+        expects = [sentinel_re, self.prompt_regex]
+        echo = cmd
+
+        def clean(text):
+            nonlocal echo
+            text = location_re.sub("", text.replace(CRLF, "\n"))
+            # Some gnuplot installations return the input statements
+            if echo:
+                if text.startswith(echo):
+                    text = text[len(echo) :].lstrip("\n")
+                echo = ""
+            return text
+
+        def write(text):
+            output.write(clean(text))
+
+        n = 0
+        while True:
+            try:
+                pos = self._expect(expects, timeout=timeout, sink=write)
+            except TIMEOUT as err:
+                raise _prompt_timeout(timeout) from err
+
+            retval = clean(cast("str", self.child.before))
+            if pos == 1:
+                self.prompt = self.child.after
+                break
+
+            output.write(retval)
+            n += 1
+
+        # The load was cut short by an error in the next statement
+        if n < len(stmts):
+            raise GnuplotError(_error_message(stmts[n], retval))
+
+        output.write(retval)
+
+    def _stream(
+        self,
+        stmts,
+        stream,
+        echo,
+        sentinel_re=None,
+        location_re=None,
+        timeout: float = 30,
+    ):
+        """
+        Pass gnuplot output to the stream as it arrives
+
+        Reading stops at the prompt. Each line is held back until
+        the next one arrives (or the stream is flushed), so that the
+        line that gnuplot repeats above an error message can be
+        left out.
+
+        Parameters
+        ----------
+        stmts : list[str]
+            Statements whose output is read. When running a batch,
+            the output of each statement ends with a sentinel.
+        stream : OutputStream
+            Where the output goes.
+        echo : list[str]
+            Lines that gnuplot may echo before the output.
+        sentinel_re : re.Pattern | None
+            Sentinel that follows the output of each statement.
+        location_re : re.Pattern | None
+            Script location that precedes error messages in a batch.
+        timeout : float
+            Maximum time to wait while gnuplot is quiet.
+        """
+        expects = [self.prompt_regex, HELP_PROMPT_RE, NEWLINE_RE]
+        if sentinel_re:
+            expects.append(sentinel_re)
+
+        def clean(text):
+            if self.piped:
+                # There are no carriage returns to remove
+                text = PIPE_PROMPT_RE.sub("", text)
+                return location_re.sub("", text) if location_re else text
+            text = text.replace(CRLF, "\n")
+            if location_re:
+                return location_re.sub("", text)
+            # Sometimes block stmts like datablocks make the
+            # the prompt leak into the return value
+            return PROMPT_REMOVE_RE.sub("", text)
+
+        echo = [line.strip() for line in echo]
+        wait = max(stream.flush_interval, MIN_WAIT)
+        quiet = 0.0
+        held = ""
+        i = 0
+        while True:
+            try:
+                pos = self._expect(expects, timeout=wait)
+            except TIMEOUT as err:
+                quiet += wait
+                if quiet >= timeout:
+                    raise _prompt_timeout(timeout) from err
+                stream.write(held)
+                stream.flush()
+                held = ""
+                continue
+
+            quiet = 0.0
+            text = clean(cast("str", self.child.before))
+            if pos == 0:
+                self.prompt = self.child.after
+                stream.write(held + text)
+                stream.flush()
+                break
+            elif pos == 1:
+                stream.write(held + text + cast("str", self.child.after))
+                held = ""
+                self._reply()
+            elif pos == 2:
+                # Some gnuplot installations return the input statements
+                if echo and text.strip() == echo[0]:
+                    echo.pop(0)
+                    continue
+                echo = []
+
+                if self.is_error_output(f"{text}\n"):
+                    if not _is_echo(held, stmts[i]):
+                        stream.write(held)
+                    stream.flush()
+                    self._force_prompt(timeout)
+                    rest = clean(cast("str", self.child.before))
+                    self.prompt = self.child.after
+                    msg = _error_message(stmts[i], f"{text}\n{rest}")
+                    raise GnuplotError(msg)
+
+                # Blank lines are held together with the next line
+                if held.strip():
+                    stream.write(held)
+                    held = ""
+                held += f"{text}\n"
+            else:
+                stream.write(held)
+                held = ""
+                i += 1
+
+        # A batch that was cut short without the usual error message
+        if sentinel_re and i < len(stmts):
+            raise GnuplotError(stmts[i])
+
+    def _run_piped(self, stmts, output):
+        """
+        Run statements over the pipe transport
+
+        The output of a statement is everything before its marker,
+        there is no echo and there are no carriage returns to
+        remove, only the prompts.
+        """
+
+        def write(text):
+            output.write(PIPE_PROMPT_RE.sub("", text))
+
+        for stmt in stmts:
+            self.send(stmt)
+            self._force_prompt(sink=write)
+            retval = cast("str", self.child.before)
+            if self.is_error_output(retval):
+                raise GnuplotError(_error_message(stmt, retval))
+            write(retval)
+
+    def _run_statements(self, stmts, output):
+        """
+        Run statements one at a time at the gnuplot prompt
+        """
+
+        def clean(text):
+            # Removing any crlfs makes subsequent
+            # processing cleaner
+            text = text.replace(CRLF, "\n")
+            # Sometimes block stmts like datablocks make the
+            # the prompt leak into the return value
+            return PROMPT_REMOVE_RE.sub("", text)
+
+        def write(text):
+            output.write(clean(text))
+
+        for line in stmts:
+            self.send(line)
+            self._force_prompt(sink=write)
+
+            retval = cast("str", self.child.before).replace(CRLF, "\n")
+            self.prompt = self.child.after
+            if self.is_error_output(retval):
+                msg = "{}\n{}".format(line, textwrap.dedent(retval))
+                raise GnuplotError(msg)
+
+            retval = clean(retval).strip(" ")
+
+            # Some gnuplot installations return the input statements
+            # We do not count those as output
+            if retval.strip() != line.strip():
+                output.write(retval)
+
     def run_command(  # pyright: ignore[reportIncompatibleMethodOverride]
         self,
         command,
@@ -223,32 +878,275 @@ class GnuplotREPLWrapper(REPLWrapper):
 
         This overrides the baseclass method to allow for
         input validation and error handling.
+
+        If a stream_handler or line_handler is given, the output
+        is passed to it as it arrives and an empty string is
+        returned. Otherwise, the output is returned. When it is
+        longer than output_limit, only its start is returned,
+        together with the name of a file with all of it.
+
+        If gnuplot reports an error, it is raised and kept in
+        the error attribute until the next command.
+        """
+        self.interrupted = False
+        self.output_path = None
+        self.error = None
+        try:
+            return self._run_command(command, stream_handler, line_handler)
+        except GnuplotError as err:
+            self.error = err
+            raise
+
+    def _run_command(self, command, stream_handler, line_handler):
+        """
+        Run code, see run_command
         """
         command = self.validate_input(command)
 
+        stream = None
+        if stream_handler or line_handler:
+            stream = OutputStream(
+                stream_handler, line_handler, self.flush_interval
+            )
+
         # Split up multiline commands and feed them in bit-by-bit
         stmts = self._splitlines(command)
-        output_lines = []
-        for line in stmts:
-            self.send(line)
-            self._force_prompt()
+        batch = self.batch and self._can_batch(stmts)
 
-            # Removing any crlfs makes subsequent
-            # processing cleaner
-            retval = cast("str", self.child.before).replace(CRLF, "\n")
-            self.prompt = self.child.after
-            if self.is_error_output(retval):
-                msg = "{}\n{}".format(line, textwrap.dedent(retval))
-                raise GnuplotError(msg)
+        # On a pipe, gnuplot would read the marker that follows a
+        # line as part of an unfinished statement
+        if self.piped and not batch:
+            stmts = self._group_statements(stmts)
 
-            # Sometimes block stmts like datablocks make the
-            # the prompt leak into the return value
-            retval = PROMPT_REMOVE_RE.sub("", retval).strip(" ")
+        with contextlib.ExitStack() as stack:
+            # Typed at the prompt, a datablock would be echoed back
+            # line by line
+            if not (batch or self.piped):
+                stmts = stack.enter_context(self._datablock_files(stmts))
 
-            # Some gnuplot installations return the input statements
-            # We do not count those as output
-            if retval.strip() != line.strip():
-                output_lines.append(retval)
+            if stream:
+                if batch:
+                    self._run_batch(stmts, stream=stream)
+                    return ""
+
+                for line in stmts:
+                    self.send(line)
+                    echo = [] if self.piped else line.splitlines()
+                    self._stream([line], stream, echo)
+                return ""
+
+            output = OutputBuffer(self.output_limit)
+            with output:
+                if batch:
+                    self._run_batch(stmts, output=output)
+                elif self.piped:
+                    self._run_piped(stmts, output)
+                else:
+                    self._run_statements(stmts, output)
+            self.output_path = output.path
+            return output.getvalue()
+
+
+def _earliest_match(patterns, text):
+    """
+    Return the pattern that matches earliest in the text
+
+    Parameters
+    ----------
+    patterns : list[re.Pattern]
+        Regular expressions
+    text : str
+        Text to search
+
+    Returns
+    -------
+    out : tuple[int, re.Match] | None
+        Index of the pattern and the match. If two patterns match
+        at the same position, the first pattern wins. None if no
+        pattern matches.
+    """
+    best = None
+    for i, pattern in enumerate(patterns):
+        m = pattern.search(text)
+        if m and (best is None or m.start() < best[1].start()):
+            best = (i, m)
+    return best
+
+
+def _exited(child):
+    """
+    Create the error for a gnuplot process that has exited
+    """
+    # Collects the exit status
+    child.isalive()
+    if child.signalstatus:
+        how = f"was killed by signal {child.signalstatus}"
+    elif child.exitstatus is not None:
+        how = f"exited with status {child.exitstatus}"
+    else:
+        how = "exited"
+    return GnuplotExited(f"gnuplot {how}.")
+
+
+def _prompt_timeout(timeout):
+    """
+    Create the error for a prompt that did not return in time
+    """
+    msg = f"gnuplot prompt failed to return in {timeout} seconds"
+    return GnuplotError(msg)
+
+
+def _error_message(line, text):
+    """
+    Create the error message for a statement that failed
+
+    Parameters
+    ----------
+    line : str
+        Statement that failed
+    text : str
+        Output of gnuplot for the statement
+    """
+    # When not at the prompt, gnuplot repeats the offending line
+    first, _, rest = text.lstrip("\n").partition("\n")
+    if _is_echo(first, line):
+        text = rest
+    text = ERROR_LOCATION_RE.sub(r"\1", text)
+    return "{}\n{}".format(line, textwrap.dedent(text))
+
+
+def _is_echo(text, stmt):
+    """
+    Return True if text is gnuplot repeating (part of) a statement
+
+    Parameters
+    ----------
+    text : str
+        Output of gnuplot
+    stmt : str
+        Statement that produced the output
+    """
+    text = ECHO_PREFIX_RE.sub("", text.strip())
+    return text not in ("", "^") and text in stmt
+
+
+class OutputStream:
+    """
+    Pass gnuplot output on to handlers as it arrives
+
+    Parameters
+    ----------
+    stream_handler : callable | None
+        Called with the pending output, at most every
+        flush_interval seconds.
+    line_handler : callable | None
+        Called with every line of output.
+    flush_interval : float
+        Maximum time (seconds) for which output is held back.
+    """
+
+    def __init__(self, stream_handler, line_handler, flush_interval):
+        self.stream_handler = stream_handler
+        self.line_handler = line_handler
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def write(self, text):
+        """
+        Write output
+        """
+        if not text:
+            return
+
+        if self.line_handler:
+            for line in text.splitlines():
+                self.line_handler(line)
+
+        if self.stream_handler:
+            self._pending.append(text)
+            elapsed = time.monotonic() - self._last_flush
+            if elapsed >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """
+        Pass on all the pending output
+        """
+        if self._pending:
+            text = "".join(self._pending)
+            self._pending = []
+            cast("Callable", self.stream_handler)(text)
+        self._last_flush = time.monotonic()
+
+
+class OutputBuffer:
+    """
+    Collect gnuplot output, in memory up to a limit
+
+    Past the limit, all the output goes to a temporary file and
+    only the start of it is kept in memory. Use it as a context
+    manager, if there is an error the file is deleted.
+
+    Parameters
+    ----------
+    limit : int
+        Maximum number of characters kept in memory.
+    """
+
+    path: Path | None = None
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self._head = []
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file:
+            self._file.close()
+            if exc_type and self.path:
+                self.path.unlink()
+                self.path = None
+
+    def write(self, text):
+        """
+        Write output
+        """
+        if not text:
+            return
+
+        if self.size + len(text) > self.limit and not self._file:
+            fd, name = tempfile.mkstemp(
+                prefix="gnuplot-output-", suffix=".txt"
+            )
+            self.path = Path(name)
+            self._file = os.fdopen(fd, "w")
+            self._file.write("".join(self._head))
+
+        if self._file:
+            self._file.write(text)
+
+        if self.size < self.limit:
+            self._head.append(text[: self.limit - self.size])
+        self.size += len(text)
+
+    def getvalue(self):
+        """
+        Return the output
+
+        If the output went to a file, only the start of it is
+        returned and a note that says where the rest is.
+        """
+        head = "".join(self._head)
+        if not self.path:
+            return head
 
-        output = "".join(output_lines)
-        return output
+        return (
+            f"{head}\n"
+            f"[Output truncated to {self.limit} of {self.size} "
+            f"characters, the full output is in {self.path}]\n"
+        )
@@ -0,0 +1,148 @@
+import os
+import shlex
+import signal
+import subprocess
+
+from metakernel import pexpect
+
+
+class PipeSpawn(pexpect.pty_spawn):
+    """
+    Run a program with its standard streams connected to pipes
+
+    Unlike a pseudo terminal, a pipe does not echo the input back
+    and does not turn newlines into carriage return & newline
+    pairs. What the program writes to stdout and stderr is read
+    from one stream, in the order that it is written.
+
+    It is a pexpect spawn that is not started in a pseudo terminal,
+    the pexpect machinery reads the stdout pipe instead.
+
+    Parameters
+    ----------
+    command : str
+        Command that starts the program.
+    encoding : str
+        Encoding of the input and output.
+    codec_errors : str
+        How to handle encoding and decoding errors.
+    """
+
+    def __init__(
+        self,
+        command,
+        encoding="utf-8",
+        codec_errors="ignore",
+        **kwargs,
+    ):
+        self.proc = subprocess.Popen(
+            shlex.split(command),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+            # Like a program in a pseudo terminal, it only gets
+            # the signals that are sent to it
+            start_new_session=True,
+        )
+        # Without a command, pexpect does not start a process.
+        # Pipes do not echo, this keeps the REPLWrapper from
+        # trying to turn off the echo.
+        super().__init__(
+            None,
+            encoding=encoding,
+            codec_errors=codec_errors,
+            echo=False,
+            **kwargs,
+        )
+        assert self.proc.stdout is not None
+        self.pid = self.proc.pid
+        self.child_fd = self.proc.stdout.fileno()
+        self.closed = False
+        self.command = command
+        self.name = f"<pipe {command}>"
+
+    def send(self, s):
+        """
+        Write to the stdin of the program
+
+        Returns the number of bytes written.
+        """
+        s = self._coerce_send_string(s)
+        self._log(s, "send")
+        b = self._encoder.encode(s, final=False)
+        stdin = self.proc.stdin
+        assert stdin is not None
+        stdin.write(b)
+        return len(b)
+
+    def sendeof(self):
+        """
+        Close the stdin of the program
+        """
+        if self.proc.stdin:
+            self.proc.stdin.close()
+
+    def sendintr(self):
+        """
+        Interrupt the program
+        """
+        self.kill(signal.SIGINT)
+
+    def kill(self, sig):
+        """
+        Send a signal to the program
+        """
+        if self.isalive():
+            os.kill(self.pid, sig)
+
+    def isalive(self):
+        """
+        Return True if the program is running
+        """
+        returncode = self.proc.poll()
+        # Negative return codes are the signals that stopped it
+        if returncode is not None and returncode < 0:
+            self.signalstatus = -returncode
+        else:
+            self.exitstatus = returncode
+        return returncode is None
+
+    def wait(self):
+        """
+        Wait for the program to exit
+
+        Returns the exit status.
+        """
+        returncode = self.proc.wait()
+        self.isalive()
+        return returncode
+
+    def close(self, force=True):
+        """
+        Close the pipes to the program
+        """
+        self.sendeof()
+        if self.proc.stdout:
+            self.proc.stdout.close()
+        self.child_fd = -1
+        self.closed = True
+
+    def terminate(self, force=False):
+        """
+        Stop the program
+
+        Returns True if the program has stopped.
+        """
+        if not self.isalive():
+            return True
+
+        self.proc.terminate()
+        try:
+            self.proc.wait(self.delayafterterminate)
+        except subprocess.TimeoutExpired:
+            if not force:
+                return False
+            self.proc.kill()
+            self.proc.wait()
+        return True
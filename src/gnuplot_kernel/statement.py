@@ -62,6 +62,44 @@ UNSET_OUTPUT_RE = re.compile(
 )
 
 
+# "help" and "?", gnuplot may prompt for a subtopic
+HELP_RE = re.compile(
+    r"^\s*"
+    r"(?:help|hel|he|h|\?)"
+    r"(?:\s+|$)"
+    r"(?!\s*=)"  # Not a variable assignment
+)
+
+# "pause" and abbreviated variants
+PAUSE_RE = re.compile(
+    r"^\s*"
+    r"(?:pause|paus|pau|pa)"
+    r"(?:\s+|$)"
+    r"(?!\s*=)"  # Not a variable assignment
+)
+
+# "exit", "quit" and abbreviated variants
+EXIT_RE = re.compile(
+    r"^\s*"
+    r"(?:exit|exi|ex|quit|qui|qu|q)"
+    r"(?:\s+|$)"
+    r"(?!\s*=)"  # Not a variable assignment
+)
+
+# The condition of an if statement, e.g. "if (x > 1)"
+IF_RE = re.compile(
+    r"^\s*"
+    r"if\s*\("
+)
+
+# The special filename '-' i.e. data that follows the statement
+INLINE_DATA_RE = re.compile(
+    r"(?P<quote>['\"])"
+    r"-"
+    r"(?P=quote)"
+)
+
+
 class STMT(str):
     """
     A gnuplot statement
@@ -96,3 +134,105 @@ class STMT(str):
         Return True if stmt is a plot statement
         """
         return bool(PLOT_RE.match(self))
+
+    def is_interactive(self):
+        """
+        Return True if stmt may wait for a response from the user
+        """
+        return bool(HELP_RE.match(self) or PAUSE_RE.match(self))
+
+    def is_exit(self):
+        """
+        Return True if stmt is an 'exit' or 'quit' statement
+        """
+        return bool(EXIT_RE.match(self))
+
+    def substatements(self):
+        """
+        Return the simple statements in stmt
+
+        A line may hold many statements, separated by ';' and in
+        the {} bodies of loops and if statements. The statement
+        after the condition of an if without braces is one too.
+        Separators in quoted strings and comments do not count.
+        """
+        parts = []
+        quote = ""
+        escaped = False
+        start = 0
+        end = len(self)
+        for i, char in enumerate(self):
+            if quote:
+                if escaped:
+                    escaped = False
+                elif char == "\\" and quote == '"':
+                    escaped = True
+                elif char == quote:
+                    quote = ""
+            elif char in "'\"":
+                quote = char
+            elif char == "#":
+                end = i
+                break
+            elif char in ";{}":
+                parts.append(self[start:i])
+                start = i + 1
+        parts.append(self[start:end])
+        return [STMT(part) for p in parts if (part := _strip_if(p)).strip()]
+
+    def count_inline_data(self):
+        """
+        Return the number of inline data ('-') sources in a plot stmt
+
+        Each source is read from the lines that follow the statement
+        and is terminated by a line with a single 'e'.
+        """
+        if not self.is_plot():
+            return 0
+        return len(INLINE_DATA_RE.findall(self))
+
+    def brace_balance(self):
+        """
+        Return the change in the nesting of {} blocks caused by stmt
+
+        Braces in quoted strings and comments do not count.
+        """
+        balance = 0
+        quote = ""
+        escaped = False
+        for char in self:
+            if quote:
+                if escaped:
+                    escaped = False
+                elif char == "\\" and quote == '"':
+                    escaped = True
+                elif char == quote:
+                    quote = ""
+            elif char in "'\"":
+                quote = char
+            elif char == "#":
+                break
+            elif char == "{":
+                balance += 1
+            elif char == "}":
+                balance -= 1
+        return balance
+
+
+def _strip_if(stmt):
+    """
+    Remove the condition of an if statement, if stmt is one
+    """
+    m = IF_RE.match(stmt)
+    if not m:
+        return stmt
+
+    depth = 1
+    for i in range(m.end(), len(stmt)):
+        if stmt[i] == "(":
+            depth += 1
+        elif stmt[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return stmt[i + 1 :]
+    return stmt
@@ -0,0 +1,111 @@
+"""
+Data computed by gnuplot, read back as NumPy arrays
+
+With ``set table``, gnuplot writes the points of the plots as text
+instead of drawing them. The text is read from a FIFO, so it never
+touches the disk, and it is converted to arrays a block at a time.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import warnings
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import numpy as np  # pyright: ignore[reportMissingImports]
+
+# Comments e.g. "# Curve 0 of 1, 100 points"
+TABLE_COMMENT_RE = re.compile(rb"(?m)^[ \t]*#.*(?:\n|$)")
+
+# The last column of the points of plot statements, whether the
+# point is in range (i), out of range (o) or undefined (u)
+TABLE_FLAG_RE = re.compile(rb"(?m)[ \t]+[iou][ \t]*$")
+
+# Blank lines, they separate the blocks of data
+TABLE_BLOCK_SEP_RE = re.compile(rb"\n(?:[ \t]*\n)+")
+
+
+class FifoReader:
+    """
+    Read all that is written to a FIFO, in a background thread
+
+    Both ends of the FIFO are opened when the reader is created, so
+    neither the writer nor the reader waits for the other to open
+    it. The reader holds its own write end, so the data of many
+    writers, one after the other, is read until close() is called.
+
+    Parameters
+    ----------
+    path : Path
+        FIFO to read
+    """
+
+    def __init__(self, path: Path):
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self._write_fd = os.open(path, os.O_WRONLY)
+        os.set_blocking(self._fd, True)
+        self._chunks: list[bytes] = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while chunk := os.read(self._fd, 1 << 20):
+            self._chunks.append(chunk)
+
+    def close(self) -> bytes:
+        """
+        Return what has been written once the writers have finished
+        """
+        os.close(self._write_fd)
+        self._thread.join()
+        os.close(self._fd)
+        return b"".join(self._chunks)
+
+
+def parse_table(data: bytes) -> list[np.ndarray]:
+    """
+    Convert the output of set table to arrays
+
+    The comments and the range flags of the points are removed with
+    regular expressions and the numbers of each block are converted
+    by numpy, the text is not split into lines in Python.
+
+    Parameters
+    ----------
+    data : bytes
+        Output of set table
+
+    Returns
+    -------
+    out : list[numpy.ndarray]
+        An array for each block of data, blocks are separated by
+        blank lines. The arrays have a row for each point and a
+        column for each value of the point.
+    """
+    import numpy as np  # pyright: ignore[reportMissingImports]
+
+    data = TABLE_COMMENT_RE.sub(b"", data)
+    data = TABLE_FLAG_RE.sub(b"", data).strip()
+    if not data:
+        return []
+
+    arrays = []
+    for block in TABLE_BLOCK_SEP_RE.split(data):
+        nrows = block.count(b"\n") + 1
+        ncols = len(block.partition(b"\n")[0].split())
+        with warnings.catch_warnings():
+            # numpy warns when it cannot parse all of the text
+            warnings.simplefilter("ignore", DeprecationWarning)
+            values = np.fromstring(block, sep=" ")
+
+        if values.size != nrows * ncols:
+            line = block.partition(b"\n")[0].decode(errors="replace")
+            msg = f"The block of data at {line!r} is not all numbers."
+            raise ValueError(msg)
+        arrays.append(values.reshape(nrows, ncols))
+    return arrays
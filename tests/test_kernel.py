@@ -1,10 +1,16 @@
+import os
+import signal
+import time
 import weakref
 from pathlib import Path
 
+import pytest
 from metakernel.tests.utils import clear_log_text, get_kernel, get_log_text
 
 from gnuplot_kernel import GnuplotKernel
+from gnuplot_kernel.capture import ImageCapture
 from gnuplot_kernel.magics import GnuplotMagic
+from gnuplot_kernel.postprocess import minify_svg
 
 from .conftest import ensure_deleted
 
@@ -272,6 +278,18 @@ plot $DATA
     assert text.count("Display Data") == 1
 
 
+def test_large_data_block():
+    kernel = get_kernel(GnuplotKernel)
+    rows = "\n".join(f"{i} {i * i}" for i in range(200_000))
+    code = f"$DATA << EOD\n{rows}\nEOD"
+    start = time.monotonic()
+    kernel.do_execute(code)
+    assert time.monotonic() - start < 10
+
+    kernel.do_execute("stats $DATA nooutput; print STATS_records")
+    assert "200000" in get_log_text(kernel)
+
+
 def test_do_for_loop():
     kernel = get_kernel(GnuplotKernel)
     code = """
@@ -284,6 +302,647 @@ def test_do_for_loop():
     assert text.count("Display Data") == 3
 
 
+def test_batch_execution():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.batch_execution = True
+
+    code = """
+    print "first"
+    do for [t=0:2] {
+      plot x**t t sprintf("x^%d",t)
+    }
+    print "last"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 3
+    assert text.index("first") < text.index("last")
+    clear_log_text(kernel)
+
+    # The error names the failing statement and stops
+    # the statements after it
+    code = """
+    print "before"
+    plot [1,2][] sin(x)
+    print "after"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert "plot [1,2][] sin(x)" in text
+    assert " ^" in text
+    assert "after" not in text
+    clear_log_text(kernel)
+
+    # Help cannot be batched but it still works
+    kernel.do_execute("help print")
+    text = get_log_text(kernel).lower()
+    assert "syntax" in text
+
+    # Nor can a pause in a loop or after a ';'
+    wrapper = kernel.wrapper
+    assert not wrapper._can_batch(["do for [i=1:3] { pause -1 }"])
+    assert not wrapper._can_batch(["a = 1; pause mouse"])
+    assert not wrapper._can_batch(["if (a > 1) exit"])
+    assert wrapper._can_batch(['print "pause; exit"'])
+
+
+def test_stream_output():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.stream_output = True
+
+    code = """
+    print "first"
+    pause 0.2
+    print "second"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.index("first") < text.index("second")
+    clear_log_text(kernel)
+
+    # Errors still stop the cell
+    code = """
+    plot [1,2][] sin(x)
+    print "after"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert " ^" in text
+    assert "after" not in text
+    clear_log_text(kernel)
+
+    # Inline plots are not affected
+    kernel.do_execute("plot sin(x)")
+    text = get_log_text(kernel)
+    assert "Display Data" in text
+
+
+def test_pipe_transport():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.transport = "pipe"
+
+    code = """
+    print "first"
+$DATA << EOD
+1 1
+2 4
+EOD
+    do for [t=0:1] {
+      plot $DATA u 1:($2**t) w lp
+    }
+    plot '-' w l
+    1 2
+    3 4
+    e
+    print "last"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert kernel.wrapper.piped
+    assert text.count("Display Data") == 3
+    assert text.index("first") < text.index("last")
+    assert "print" not in text
+    clear_log_text(kernel)
+
+    # Errors stop the statements after them
+    code = """
+    plot [1,2][] sin(x)
+    print "after"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert "plot [1,2][] sin(x)" in text
+    assert " ^" in text
+    assert "line 0" not in text
+    assert "after" not in text
+    clear_log_text(kernel)
+
+    # The error does not end the session
+    assert kernel.wrapper.child.isalive()
+    kernel.do_execute('set print "-"; print "stdout"; printerr "stderr"')
+    text = get_log_text(kernel)
+    assert text.index("stdout") < text.index("stderr")
+
+
+def test_search_window():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.search_window = 16
+    kernel.read_size = 64
+
+    # The prompt is found when the output is much longer than
+    # the search window and the reads
+    code = """
+    do for [i=1:2000] {
+      print sprintf("line %04d", i)
+    }
+    print "last"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert kernel.wrapper.search_window == 16
+    assert text.count("line ") == 2000
+    assert "last" in text
+
+
+def test_output_limit():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.output_limit = 100
+
+    code = """
+    do for [i=1:1000] {
+      print sprintf("line %04d", i)
+    }
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert "line 0001" in text
+    assert "line 1000" not in text
+    assert "Output truncated" in text
+
+    # The full output is in the file
+    filename = text.split("the full output is in ")[1].split("]")[0]
+    with ensure_deleted(filename) as f:
+        assert f.read_text().count("line ") == 1000
+
+
+def test_process_pool(tmp_path, monkeypatch):
+    kernel = get_kernel(GnuplotKernel)
+    # Nothing is started before it is needed
+    assert kernel._pool._ready.empty()
+    assert not kernel._pool._starting
+
+    kernel.do_execute('print "first"')
+    pid = kernel.wrapper.child.pid
+
+    # A restart takes the next process from the pool
+    kernel.wrapper.exit()
+    kernel.restart_kernel()
+    assert kernel.wrapper.child.pid != pid
+    kernel.do_execute('print "second"')
+    assert "second" in get_log_text(kernel)
+
+    # The process gets the terminal and working directory that
+    # were set after it was started
+    kernel.do_execute("%gnuplot inline svg size 300,200")
+    monkeypatch.chdir(tmp_path)
+    kernel.wrapper.exit()
+    kernel.restart_kernel()
+    kernel.do_execute("print GPVAL_TERM; print GPVAL_PWD")
+    text = get_log_text(kernel)
+    assert "svg" in text
+    assert str(tmp_path) in text
+
+    # Without a pool, gnuplot is started when it is needed
+    kernel.pool_size = 0
+    kernel.wrapper.exit()
+    kernel.restart_kernel()
+    kernel.do_execute('print "third"')
+    assert "third" in get_log_text(kernel)
+
+
+def test_checkpoint():
+    kernel = get_kernel(GnuplotKernel)
+    code = """
+    f(x) = 2*x
+    a = 3
+$DATA << EOD
+1 1
+2 4
+EOD
+    """
+    kernel.do_execute(code)
+    kernel.save_checkpoint()
+
+    # A new gnuplot process has the state of the checkpoint
+    kernel.wrapper.exit()
+    kernel.restart_kernel()
+    kernel.do_execute("print f(a), |$DATA|")
+    text = get_log_text(kernel)
+    assert "6 2" in text
+    clear_log_text(kernel)
+
+    # The checkpoint can be saved after every cell
+    kernel.auto_checkpoint = True
+    kernel.do_execute("b = 4")
+    kernel.wrapper.exit()
+    kernel.restart_kernel()
+    kernel.do_execute("print b")
+    assert "4" in get_log_text(kernel)
+    clear_log_text(kernel)
+
+    # and it survives the kernel through the checkpoint file
+    with ensure_deleted("checkpoint.json") as filename:
+        kernel.checkpoint_file = str(filename)
+        kernel.save_checkpoint()
+        kernel2 = get_kernel(GnuplotKernel)
+        kernel2.checkpoint_file = str(filename)
+        kernel2.do_execute("print f(b)")
+        assert "8" in get_log_text(kernel2)
+
+
+def test_respawn():
+    kernel = get_kernel(GnuplotKernel)
+    code = """
+$DATA << EOD
+1 1
+2 4
+EOD
+    """
+    kernel.do_execute(code)
+
+    # The death of gnuplot is noticed at once and reported
+    os.kill(kernel.wrapper.child.pid, signal.SIGKILL)
+    start = time.monotonic()
+    kernel.do_execute('print "lost"')
+    assert time.monotonic() - start < 5
+    text = get_log_text(kernel)
+    assert "killed by signal" in text
+    assert "restarted" in text
+    clear_log_text(kernel)
+
+    # The new gnuplot has the datablocks and can plot
+    kernel.do_execute("print |$DATA|")
+    assert "2" in get_log_text(kernel)
+    kernel.do_execute("plot $DATA")
+    assert "Display Data" in get_log_text(kernel)
+
+
+def test_interrupt():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.do_execute('print "ready"')
+    clear_log_text(kernel)
+
+    # Time from the interrupt to a prompt that takes statements
+    wrapper = kernel.wrapper
+    wrapper.send("pause 30")
+    time.sleep(0.5)
+    start = time.monotonic()
+    wrapper.interrupt()
+    wrapper.run_command('print "usable"')
+    duration = time.monotonic() - start
+    assert duration < 1
+    assert wrapper.child.isalive()
+
+    # The session is still usable from the kernel
+    kernel.do_execute('print "after"')
+    assert "after" in get_log_text(kernel)
+
+
+def test_image_dir(tmp_path):
+    kernel = get_kernel(GnuplotKernel)
+
+    # By default, the kernel has an image directory of its own
+    kernel.do_execute("plot sin(x)")
+    assert "Display Data" in get_log_text(kernel)
+    assert "gnuplot-kernel-" in str(kernel.get_image_dir())
+    clear_log_text(kernel)
+
+    kernel.image_dir = str(tmp_path)
+    code = """
+    do for [t=0:2] {
+      plot x**t t sprintf("x^%d",t)
+    }
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 3
+    assert kernel.get_image_dir() == tmp_path
+
+    # The images are deleted after they are displayed
+    assert not any(tmp_path.iterdir())
+
+
+def test_progressive_display():
+    kernel = get_kernel(GnuplotKernel)
+
+    # The first plot is displayed while the cell is still running,
+    # before the output of the cell
+    code = """
+    plot sin(x)
+    plot cos(x)
+    pause 0.5
+    print "done"
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 2
+    assert text.index("Display Data") < text.index("done")
+    clear_log_text(kernel)
+
+    kernel.progressive_display = False
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 2
+    assert text.index("Display Data") > text.index("done")
+
+
+def test_image_transport():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.image_transport = "comm"
+
+    # The renderer is installed once, and until it opens the
+    # comm the images are displayed as usual
+    kernel.do_execute("plot sin(x)")
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 2
+    clear_log_text(kernel)
+
+    kernel.do_execute("plot cos(x)")
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 1
+
+    class Comm:
+        def __init__(self):
+            self.sent = []
+            self.closed = False
+
+        def send(self, data, buffers):
+            self.sent.append(data["id"])
+
+        def on_msg(self, callback):
+            self.ack = callback
+
+        def on_close(self, callback):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    # Acknowledged images keep the comm
+    comm = Comm()
+    kernel._open_image_comm(comm, {})
+    kernel.do_execute("plot sin(x)")
+    comm.ack({"content": {"data": {"id": comm.sent[-1]}}})
+    kernel.do_execute("plot cos(x)")
+    assert not comm.closed
+    assert len(comm.sent) == 2
+
+    # Without an acknowledgement the renderer is installed again
+    # and the images are displayed as usual
+    clear_log_text(kernel)
+    kernel.do_execute("plot sin(x)")
+    assert comm.closed
+    assert len(comm.sent) == 2
+    assert get_log_text(kernel).count("Display Data") == 2
+
+
+def test_image_capture():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.image_capture = "fifo"
+
+    code = """
+    do for [t=0:2] {
+      plot x**t
+    }
+    plot sin(x)
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 4
+    assert "Failed to read" not in text
+    clear_log_text(kernel)
+
+    # Only the FIFOs are in the image directory
+    names = {f.name for f in kernel.get_image_dir().iterdir()}
+    assert names == {"gnuplot-capture-0", "gnuplot-capture-1"}
+
+    # An error leaves no output open
+    kernel.do_execute("plot [1,2][] sin(x)")
+    kernel.do_execute("plot cos(x)")
+    assert get_log_text(kernel).count("Display Data") == 1
+
+
+def test_image_capture_close(tmp_path):
+    capture = ImageCapture(tmp_path)
+    # A writer that does not close the FIFO
+    fd = os.open(capture.fifos[0], os.O_WRONLY)
+    try:
+        start = time.monotonic()
+        capture.close(timeout=0.2)
+        assert time.monotonic() - start < 2
+    finally:
+        os.close(fd)
+
+
+def test_max_images(tmp_path):
+    kernel = get_kernel(GnuplotKernel)
+    kernel.max_images = 3
+    code = """
+    do for [t=1:10] {
+      plot x**t
+    }
+    """
+
+    # The first images and the last image are displayed
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 3
+    assert "7 images were not displayed" in text
+    clear_log_text(kernel)
+
+    # The images left out can be kept
+    kernel.hidden_image_dir = str(tmp_path)
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 3
+    assert len(list(tmp_path.iterdir())) == 7
+
+
+def test_postprocess_images():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.png_compress_level = 9
+    kernel.do_execute("plot sin(x)")
+    assert "Display Data" in get_log_text(kernel)
+    clear_log_text(kernel)
+
+    kernel.call_magic("%gnuplot inline svg")
+    kernel.svg_precision = 1
+    kernel.do_execute("plot sin(x)")
+    assert "Display Data" in get_log_text(kernel)
+
+    # Coordinates are rounded, texts are not changed
+    svg = b"""<g>
+    <path d="M 54.53,422.40 L -0.04,3.00"/>
+    <text x="10.00"> 0.25 </text>
+</g>"""
+    assert minify_svg(svg) == (
+        b'<g><path d="M 54.5,422.4 L 0,3"/><text x="10"> 0.25 </text></g>'
+    )
+
+
+def test_heavy_svg():
+    kernel = get_kernel(GnuplotKernel)
+    kernel.call_magic("%gnuplot inline svg")
+    svg = b"<svg><g><path d='M 0,0'/></g></svg>"
+    assert not kernel.is_heavy_svg(svg)
+
+    # A heavy image is displayed, as PNG if cairosvg is installed
+    kernel.svg_max_elements = 2
+    assert kernel.is_heavy_svg(svg)
+    kernel.do_execute("plot sin(x)")
+    assert "Display Data" in get_log_text(kernel)
+
+
+def test_render_cache(tmp_path):
+    kernel = get_kernel(GnuplotKernel)
+    cache = tmp_path / "cache"
+    kernel.render_cache_dir = str(cache)
+
+    # The second time, the image comes from the cache
+    kernel.do_execute("plot sin(x)")
+    kernel.do_execute("plot sin(x)")
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 2
+    assert len(list(cache.iterdir())) == 1
+    clear_log_text(kernel)
+
+    # The reset code runs after a cell that comes from the cache
+    marker = tmp_path / "reset"
+    kernel.reset_code = f"system \"touch '{marker}'\""
+    kernel.do_execute("plot sin(x)")
+    assert marker.exists()
+    assert len(list(cache.iterdir())) == 1
+    kernel.reset_code = ""
+
+    # Cells that change the session are not cached, and a change
+    # in the session is a different entry
+    kernel.do_execute("set xrange [0:1]")
+    kernel.do_execute("plot sin(x)")
+    assert len(list(cache.iterdir())) == 2
+
+    # Nor are cells that do more than plot, or that fail
+    kernel.do_execute("plot sin(x); set yrange [0:1]")
+    kernel.do_execute("plot sin(y)")
+    assert len(list(cache.iterdir())) == 2
+
+    # Data files are relative to the directory of gnuplot
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "data.txt").write_text(f"1 {len(name)}\n")
+        kernel.do_execute(f"cd '{tmp_path / name}'")
+        kernel.do_execute("plot 'data.txt' using 1:2")
+    assert len(list(cache.iterdir())) == 4
+
+    # The least recently used images are evicted
+    kernel.render_cache_size = 1
+    kernel.do_execute("plot cos(x)")
+    assert len(list(cache.iterdir())) == 0
+
+
+def test_push_array():
+    np = pytest.importorskip("numpy")
+    kernel = get_kernel(GnuplotKernel)
+
+    x = np.linspace(0, 10, 1000)
+    kernel.push_array("DATA", np.column_stack([x, x**2]))
+    kernel.do_execute("plot @DATA using 1:2 with lines")
+    assert "Display Data" in get_log_text(kernel)
+    clear_log_text(kernel)
+
+    # Pushing again replaces the data
+    kernel.push_array("DATA", x.astype(np.float32))
+    kernel.do_execute("stats @DATA using 1 nooutput; print STATS_records")
+    assert "1000" in get_log_text(kernel)
+
+    with pytest.raises(ValueError, match="Datablocks"):
+        kernel.push_array("$DATA", x)
+
+
+def test_pull_table():
+    np = pytest.importorskip("numpy")
+    kernel = get_kernel(GnuplotKernel)
+
+    tables = kernel.pull_table("set samples 11\nplot [0:10] x**2, 2*x")
+    assert len(tables) == 2
+    assert tables[0].shape == (11, 2)
+    np.testing.assert_allclose(tables[0][:, 1], np.arange(11) ** 2)
+    np.testing.assert_allclose(tables[1][:, 1], 2 * np.arange(11))
+
+    # The table is unset afterwards, plots are displayed again
+    kernel.do_execute("plot x")
+    assert "Display Data" in get_log_text(kernel)
+
+
+def test_data_cache(tmp_path):
+    kernel = get_kernel(GnuplotKernel)
+    kernel.data_cache_dir = str(tmp_path / "cache")
+    data = tmp_path / "data.txt"
+    data.write_text("# x y\n1 1\n2 4\n3 9\n")
+
+    # The binary copy is made once and has the same data
+    code = f"stats '{data}' using 2 nooutput; print STATS_sum"
+    kernel.do_execute(code)
+    kernel.do_execute(code)
+    assert get_log_text(kernel).count("14") == 2
+    assert len(list((tmp_path / "cache").glob("*.bin"))) == 1
+
+    # '' is the previous file, it reads the copy as binary too
+    code2 = f"plot '{data}' using 1:2 with lines, '' using 2:1"
+    assert kernel.get_data_cache().rewrite(code2).count(" binary ") == 2
+    kernel.do_execute(code2)
+    assert "Display Data" in get_log_text(kernel)
+
+    # A changed file gets a new copy
+    data.write_text("1 1\n2 4\n3 9\n4 16\n")
+    kernel.do_execute(code)
+    assert "30" in get_log_text(kernel)
+    assert len(list((tmp_path / "cache").glob("*.bin"))) == 2
+
+    # Relative names are relative to the directory of gnuplot
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "data.txt").write_text("1 5\n2 6\n")
+    kernel.do_execute(f"cd '{other}'")
+    clear_log_text(kernel)
+    kernel.do_execute("stats 'data.txt' using 2 nooutput; print STATS_sum")
+    assert "11" in get_log_text(kernel)
+    assert len(list((tmp_path / "cache").glob("*.bin"))) == 3
+
+
+def test_downsample(tmp_path):
+    pytest.importorskip("numpy")
+    kernel = get_kernel(GnuplotKernel)
+    data = tmp_path / "data.txt"
+    data.write_text("".join(f"{i} {i % 7}\n" for i in range(100_000)))
+
+    # Off by default
+    code = f"plot '{data}' using 1:2 with lines"
+    kernel.do_execute(code)
+    assert "Downsampled" not in get_log_text(kernel)
+
+    kernel.do_execute(f"%%downsample\n{code}")
+    text = get_log_text(kernel)
+    assert "Downsampled" in text
+    assert "from 100,000 to" in text
+    assert "Display Data" in text
+
+    # Points are plotted as they are
+    clear_log_text(kernel)
+    kernel.do_execute(f"%downsample\nplot '{data}' using 1:2 with points")
+    assert "Downsampled" not in get_log_text(kernel)
+    assert kernel.downsample
+
+    # Not when the x axis is not the range of the data
+    clear_log_text(kernel)
+    kernel.do_execute(f"plot [0:10] '{data}' using 1:2 with lines")
+    kernel.do_execute(f"set logscale x\n{code}")
+    kernel.do_execute(f"unset logscale\nset xrange [0:10]\n{code}")
+    kernel.do_execute(code)
+    # Column 0 is the number of the point
+    kernel.do_execute(f"plot '{data}' using 0:2 with lines")
+    kernel.do_execute("unset xrange")
+    # Smoothing needs all the points
+    kernel.do_execute(f"plot '{data}' using 1:2 smooth cumulative with lines")
+    assert "Downsampled" not in get_log_text(kernel)
+
+    # '' is the previous file, each line is downsampled on its own
+    clear_log_text(kernel)
+    kernel.do_execute(f"plot '{data}' using 1:2 with lines, '' using 2:1")
+    text = get_log_text(kernel)
+    assert text.count("Downsampled") == 1
+    assert "Display Data" in text
+
+
 # magics #
 
 
@@ -363,3 +1022,26 @@ def test_reset_line_magic():
     # metakernel messes this exception!!
     # with assert_raises(ValueError):
     #     kernel.call_magic('%gnuplot inline qt')
+
+
+def test_animation_line_magic():
+    kernel = get_kernel(GnuplotKernel)
+
+    # All the plots of a cell make one animated image
+    kernel.call_magic("%gnuplot inline gif animate delay 10")
+    code = """
+    do for [t=0:4] {
+      plot x**t t sprintf("x^%d",t)
+    }
+    plot sin(x)
+    """
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 1
+    clear_log_text(kernel)
+
+    # Other terminals make an image per plot
+    kernel.call_magic("%gnuplot inline pngcairo")
+    kernel.do_execute(code)
+    text = get_log_text(kernel)
+    assert text.count("Display Data") == 6
@@ -0,0 +1,65 @@
+"""
+Time how long the kernel takes to read a large output from gnuplot
+
+A single statement (a do-for loop) prints the output, so all of it
+is read while waiting for one prompt. The file into which the output
+spills past the output limit is measured and then deleted.
+
+Usage
+-----
+    python tools/benchmark_output.py [megabytes] [search_window]
+
+e.g. compare the default search window with a window that covers
+all the output
+
+    python tools/benchmark_output.py 100
+    python tools/benchmark_output.py 100 1000000000
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+
+from gnuplot_kernel.replwrap import PROMPT_RE, GnuplotREPLWrapper
+
+# Characters in a line of output, including the newline
+LINE_SIZE = 100
+
+
+def benchmark(megabytes: float, search_window: int | None = None):
+    wrapper = GnuplotREPLWrapper(
+        cmd_or_spawn="env PAGER=cat gnuplot",
+        prompt_regex=PROMPT_RE,
+        prompt_change_cmd=None,
+    )
+    wrapper.child.delaybeforesend = 0
+    if search_window is not None:
+        wrapper.search_window = search_window
+
+    n = int(megabytes * 1e6 / LINE_SIZE)
+    # "line 0000001 xxx...x"
+    fill = "x" * (LINE_SIZE - 14)
+    code = f'do for [i=1:{n}] {{ print sprintf("line %07d {fill}", i) }}'
+
+    start = time.perf_counter()
+    try:
+        output = wrapper.run_command(code)
+        duration = time.perf_counter() - start
+        # Past the output limit, all of the output is in a file
+        path = wrapper.output_path
+        size = (path.stat().st_size if path else len(output)) / 1e6
+    finally:
+        if wrapper.output_path:
+            wrapper.output_path.unlink(missing_ok=True)
+        wrapper.exit()
+
+    print(f"search window: {wrapper.search_window}")
+    rate = size / duration
+    print(f"read: {size:.1f} MB in {duration:.2f}s ({rate:.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    search_window = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    benchmark(megabytes, search_window)